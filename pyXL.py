@@ -33,21 +33,94 @@
 #   Added support for errored loads.
 #   Removed debugging code.
 #   Updated csv export to use csv.writer.
+# v8 (19th October 2026):
+#   Added find, find next, replace all and column filter (CellIndex class).
+# v9 (19th October 2026):
+#   Added sorting of rows by one or more columns (formula references follow the sorted cells).
+# v10 (19th October 2026):
+#   Added CellReferenceCodec for all cell reference / label conversions.
+#   Fixed references to columns past Z resolving to the wrong cells.
+# v11 (19th October 2026):
+#   Added import of gzip, bz2 and xz compressed files, stdin and URLs (SeparatedFileReader class).
+#   Added separator detection for imports.
+#   Imports are read and decompressed on a background thread.
+# v12 (19th October 2026):
+#   Added xlsx and ods import and export (XlsxFile and OdsFile classes).
+# v13 (19th October 2026):
+#   Added headless server mode (SpreadsheetServer class) - pyXL.py --serve sheet.pyx
+# v14 (19th October 2026):
+#   Added what-if scenarios built on copy-on-write sheet snapshots (SheetSnapshot and Scenario classes).
+#   Scenarios are saved in the pyXL file.
 #-------------------------------------------------------------------------------
 
 #!/usr/bin/env python
 
 import wx
 import wx.grid
+import wx.lib.dialogs
 import os
 import sys
 import csv
 import re
+import bisect
+import itertools
+import gc
+import zlib
+import bz2
+import threading
+import Queue
+import urllib2
+import zipfile
+import tempfile
+import socket
+import asyncore
+import asynchat
+import json
+import weakref
+from xml.sax.saxutils import escape, quoteattr
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
 import sqlite3 as sqlite
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        # xz imports are unavailable
+        lzma = None
 from wx.html import HtmlEasyPrinting
 
 NUMBER_GRID_ROWS = 256
 NUMBER_GRID_COLS = 256
+CELL_REFERENCE_PATTERN = re.compile(r"\b[A-Z]+[0-9]+\b")
+IMPORT_CHUNK_SIZE = 1024 * 1024
+IMPORT_ROWS_PER_BATCH = 1000
+IMPORT_QUEUE_SIZE = 16
+# Seconds between calls to an import's progress callback while it waits for data, and before a URL gives up
+IMPORT_POLL_INTERVAL = 0.1
+IMPORT_URL_TIMEOUT = 30
+SEPARATOR_SAMPLE_SIZE = 16 * 1024
+SEPARATORS = ",\t; "
+COMPRESSION_SIGNATURES = (("\x1f\x8b", "gzip"), ("BZh", "bz2"), ("\xfd7zXZ\x00", "xz"))
+IMPORT_CELLS_PER_BATCH = 10000
+# Conversions a CellReferenceCodec keeps before it starts its cache again
+CELL_REFERENCE_CACHE_SIZE = 100000
+# Bulk updates with more changes than this to a column re-sort its numbers rather than patching them one at a time
+SORTED_NUMBERS_PATCH_LIMIT = 2000
+# Formulas pyXL can calculate, e.g. A1+B2-C5
+PYXL_FORMULA_PATTERN = re.compile(r"[A-Z]+[0-9]+([-+*/][A-Z]+[0-9]+)*$")
+NUMBER_PATTERN = re.compile(r"-?(0|[1-9][0-9]*)(\.[0-9]+)?([eE][-+]?[0-9]+)?$")
+XLSX_NAMESPACE = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+XLSX_RELATIONSHIPS_NAMESPACE = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+ODS_OFFICE_NAMESPACE = "urn:oasis:names:tc:opendocument:xmlns:office:1.0"
+ODS_TABLE_NAMESPACE = "urn:oasis:names:tc:opendocument:xmlns:table:1.0"
+ODS_TEXT_NAMESPACE = "urn:oasis:names:tc:opendocument:xmlns:text:1.0"
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8900
+SERVER_POLL_TIMEOUT = 0.05
 
 #---Model objects
 
@@ -75,6 +148,19 @@ class SpreadsheetDatabase(object):
         #   field_type = reference to spreadsheet_field_type.type
         #   value = value stored in field
         self.cursor.execute("CREATE TABLE spreadsheet_data (row_id INTEGER, column_id INTEGER, value VARCHAR(256))")
+        # scenario_data (the cells that differ from the sheet in each what-if scenario):
+        #   scenario_name = name of the scenario
+        #   row_id = field row
+        #   column_id = field column
+        #   value = value entered in the scenario
+        self.cursor.execute("CREATE TABLE scenario_data (scenario_name VARCHAR(256), row_id INTEGER, column_id INTEGER, value VARCHAR(256))")
+        # scenario_base_data (the cells of the sheet each scenario was created from that have since changed in the sheet):
+        #   scenario_name = name of the scenario
+        #   row_id = field row
+        #   column_id = field column
+        #   value = value the field had (NULL if it was empty)
+        #   formula = formula the field had (NULL if none)
+        self.cursor.execute("CREATE TABLE scenario_base_data (scenario_name VARCHAR(256), row_id INTEGER, column_id INTEGER, value VARCHAR(256), formula VARCHAR(256))")
 
     def __databaseCommit(self):
         """Commits inserted / updated data into database"""
@@ -105,10 +191,1072 @@ class SpreadsheetDatabase(object):
         self.__databaseCommit()
         self.__closeDatabase()
 
+    def loadScenarios(self):
+        """Loads the scenario cells as a list of (name, row, col, value)"""
+        self.__openDatabase()
+        try:
+            self.cursor.execute("SELECT * from scenario_data")
+            scenarioData = self.cursor.fetchall()
+        except sqlite.OperationalError:
+            # Files saved before scenarios were added don't have the table
+            scenarioData = []
+        self.__closeDatabase()
+        return scenarioData
+
+    def saveScenarios(self, scenarioList):
+        """Saves scenario cells from a list of (name, row, col, value)"""
+        self.__openDatabase()
+        self.cursor.executemany("INSERT INTO scenario_data VALUES (?, ?, ?, ?)", scenarioList)
+        self.__databaseCommit()
+        self.__closeDatabase()
+
+    def loadScenarioBases(self):
+        """Loads the cells the scenarios were created from as a list of (name, row, col, value, formula)"""
+        self.__openDatabase()
+        try:
+            self.cursor.execute("SELECT * from scenario_base_data")
+            baseData = self.cursor.fetchall()
+        except sqlite.OperationalError:
+            # Files saved before scenario bases were kept don't have the table
+            baseData = []
+        self.__closeDatabase()
+        return baseData
+
+    def saveScenarioBases(self, baseList):
+        """Saves the cells the scenarios were created from, from a list of (name, row, col, value, formula)"""
+        self.__openDatabase()
+        self.cursor.executemany("INSERT INTO scenario_base_data VALUES (?, ?, ?, ?, ?)", baseList)
+        self.__databaseCommit()
+        self.__closeDatabase()
+
     def __insertRow(self, row, col, type, value):
         """Inserts a row into spreadsheet_data"""
         self.cursor.execute("INSERT INTO spreadsheet_data VALUES (?, ?, ?)", (row, col, value))
 
+class CellIndex(object):
+    """Index of the values held in the spreadsheet, used for find, replace and filter"""
+    def __init__(self):
+        self.reInitialise()
+
+    def reInitialise(self):
+        """Empties the index"""
+        # cellsByValue = {value text: set of (row, col)}
+        # rowsByCol = {col: set of populated rows}
+        # numbersByCol = {col: {row: number}}
+        # sortedNumbersByCol = {col: [(number, row), ...]} - built on first range query
+        # pendingNumbers = {col: (set of added (number, row), set of removed (number, row))} - None outside bulk updates
+        self.cellsByValue = {}
+        self.rowsByCol = {}
+        self.numbersByCol = {}
+        self.sortedNumbersByCol = {}
+        self.pendingNumbers = None
+        self.bulkUpdateDepth = 0
+
+    def add(self, row, col, value):
+        """Adds a cell value to the index"""
+        key = self.__valueKey(value)
+        cells = self.cellsByValue.get(key)
+        if cells is None:
+            cells = self.cellsByValue[key] = set()
+        cells.add((row, col))
+        rows = self.rowsByCol.get(col)
+        if rows is None:
+            rows = self.rowsByCol[col] = set()
+        rows.add(row)
+        number = self.__numberOrNone(value)
+        if number is not None:
+            numbers = self.numbersByCol.get(col)
+            if numbers is None:
+                numbers = self.numbersByCol[col] = {}
+            numbers[row] = number
+            sortedNumbers = self.sortedNumbersByCol.get(col)
+            if sortedNumbers is not None:
+                if self.pendingNumbers is None:
+                    bisect.insort(sortedNumbers, (number, row))
+                else:
+                    self.__queueSortedChange(col, (number, row), True)
+
+    def remove(self, row, col, value):
+        """Removes a cell value from the index"""
+        key = self.__valueKey(value)
+        cells = self.cellsByValue.get(key)
+        if cells is not None:
+            cells.discard((row, col))
+            if not cells:
+                del self.cellsByValue[key]
+        rows = self.rowsByCol.get(col)
+        if rows is not None:
+            rows.discard(row)
+        numbers = self.numbersByCol.get(col)
+        if numbers is not None and row in numbers:
+            number = numbers.pop(row)
+            sortedNumbers = self.sortedNumbersByCol.get(col)
+            if sortedNumbers is not None:
+                if self.pendingNumbers is None:
+                    self.__removeSortedNumber(sortedNumbers, (number, row))
+                else:
+                    self.__queueSortedChange(col, (number, row), False)
+
+    def moveRows(self, col, rowMoves):
+        """Re-indexes the values of a column that have moved rows, given a list of (oldRow, newRow, value).
+        Rows that nothing moved into are left empty."""
+        if not rowMoves:
+            return
+        cellsByValue = self.cellsByValue
+        # Take every moved cell out before putting any back, as rows may swap places
+        cellSets = [cellsByValue[value if isinstance(value, basestring) else "%s" % value] for (oldRow, newRow, value) in rowMoves]
+        for cells, (oldRow, newRow, value) in itertools.izip(cellSets, rowMoves):
+            cells.discard((oldRow, col))
+        for cells, (oldRow, newRow, value) in itertools.izip(cellSets, rowMoves):
+            cells.add((newRow, col))
+        rows = self.rowsByCol[col]
+        rows.difference_update([oldRow for (oldRow, newRow, value) in rowMoves])
+        rows.update([newRow for (oldRow, newRow, value) in rowMoves])
+        numbers = self.numbersByCol.get(col)
+        if not numbers:
+            return
+        movedNumbers = [(newRow, numbers.pop(oldRow)) for (oldRow, newRow, value) in rowMoves if oldRow in numbers]
+        numbers.update(movedNumbers)
+        # Most of the column's numbers have changed rows, so re-sort it now rather than on the next range query
+        if col in self.sortedNumbersByCol:
+            self.sortedNumbersByCol[col] = sorted(itertools.izip(numbers.itervalues(), numbers.iterkeys()))
+            if self.pendingNumbers is not None:
+                self.pendingNumbers.pop(col, None)
+
+    def startBulkUpdate(self):
+        """Starts a bulk update - changes to the sorted numeric lists are held back until finishBulkUpdate"""
+        if self.bulkUpdateDepth == 0:
+            self.pendingNumbers = {}
+        self.bulkUpdateDepth += 1
+
+    def finishBulkUpdate(self):
+        """Applies the changes held back since startBulkUpdate to the sorted lists of the columns they affect"""
+        self.bulkUpdateDepth -= 1
+        if self.bulkUpdateDepth > 0:
+            return
+        pendingNumbers = self.pendingNumbers
+        self.pendingNumbers = None
+        for col, (addedNumbers, removedNumbers) in pendingNumbers.iteritems():
+            sortedNumbers = self.sortedNumbersByCol.get(col)
+            if sortedNumbers is None:
+                continue
+            if len(addedNumbers) + len(removedNumbers) <= SORTED_NUMBERS_PATCH_LIMIT:
+                for entry in removedNumbers:
+                    self.__removeSortedNumber(sortedNumbers, entry)
+                for entry in addedNumbers:
+                    bisect.insort(sortedNumbers, entry)
+                continue
+            if removedNumbers:
+                sortedNumbers = [entry for entry in sortedNumbers if entry not in removedNumbers]
+            # Sorting a sorted list with a sorted run on the end only has to merge the two
+            sortedNumbers.extend(sorted(addedNumbers))
+            sortedNumbers.sort()
+            self.sortedNumbersByCol[col] = sortedNumbers
+
+    def __queueSortedChange(self, col, entry, added):
+        """Records an entry added to or removed from a column's sorted numbers during a bulk update"""
+        changes = self.pendingNumbers.get(col)
+        if changes is None:
+            changes = self.pendingNumbers[col] = (set(), set())
+        addedNumbers, removedNumbers = changes
+        if added:
+            if entry in removedNumbers:
+                removedNumbers.discard(entry)
+            else:
+                addedNumbers.add(entry)
+        elif entry in addedNumbers:
+            addedNumbers.discard(entry)
+        else:
+            removedNumbers.add(entry)
+
+    def __removeSortedNumber(self, sortedNumbers, entry):
+        """Removes a (number, row) entry from a sorted list"""
+        position = bisect.bisect_left(sortedNumbers, entry)
+        if position < len(sortedNumbers) and sortedNumbers[position] == entry:
+            del sortedNumbers[position]
+
+    def findCells(self, text, matchWholeCell=True):
+        """Returns a row-ordered list of the cells whose value matches text"""
+        if matchWholeCell:
+            cells = self.cellsByValue.get(text, ())
+            return sorted(cells)
+        matches = []
+        for key, cells in self.cellsByValue.iteritems():
+            if text in key:
+                matches.extend(cells)
+        return sorted(matches)
+
+    def findValues(self, text):
+        """Returns the distinct indexed values that contain text"""
+        return [key for key in self.cellsByValue if text in key]
+
+    def filterColumn(self, col, predicate):
+        """Returns a sorted list of the rows in col that match a predicate (e.g. "> 100", "<> 0", "abc")"""
+        operator, operand = self.__parsePredicate(predicate)
+        rows = self.rowsByCol.get(col, set())
+        number = self.__numberOrNone(operand)
+        if operator == "=":
+            if number is None:
+                return sorted(row for (row, cellCol) in self.cellsByValue.get(operand, ()) if cellCol == col)
+            return sorted(self.__numberRange(col, number, True, number, True))
+        if operator == "<>":
+            if number is None:
+                equalRows = set(row for (row, cellCol) in self.cellsByValue.get(operand, ()) if cellCol == col)
+            else:
+                equalRows = set(self.__numberRange(col, number, True, number, True))
+            return sorted(rows - equalRows)
+        if number is None:
+            raise ValueError("Filter value must be a number for %s" % operator)
+        if operator == ">":
+            return sorted(self.__numberRange(col, number, False, None, False))
+        if operator == ">=":
+            return sorted(self.__numberRange(col, number, True, None, False))
+        if operator == "<":
+            return sorted(self.__numberRange(col, None, False, number, False))
+        return sorted(self.__numberRange(col, None, False, number, True))
+
+    def __numberRange(self, col, low, includeLow, high, includeHigh):
+        """Returns the rows in col whose numeric value lies between low and high (None = unbounded)"""
+        sortedNumbers = self.__sortedNumbers(col)
+        if low is None:
+            start = 0
+        elif includeLow:
+            start = bisect.bisect_left(sortedNumbers, (low, -1))
+        else:
+            start = bisect.bisect_right(sortedNumbers, (low, sys.maxint))
+        if high is None:
+            end = len(sortedNumbers)
+        elif includeHigh:
+            end = bisect.bisect_right(sortedNumbers, (high, sys.maxint))
+        else:
+            end = bisect.bisect_left(sortedNumbers, (high, -1))
+        return [row for (number, row) in sortedNumbers[start:end]]
+
+    def __sortedNumbers(self, col):
+        """Returns the numeric values in col as a sorted list of (number, row), building it if needed"""
+        sortedNumbers = self.sortedNumbersByCol.get(col)
+        if sortedNumbers is None:
+            numbers = self.numbersByCol.get(col, {})
+            sortedNumbers = sorted((number, row) for (row, number) in numbers.iteritems())
+            self.sortedNumbersByCol[col] = sortedNumbers
+        return sortedNumbers
+
+    def __parsePredicate(self, predicate):
+        """Splits a filter predicate into an operator and an operand"""
+        match = re.match(r"\s*(>=|<=|<>|>|<|=)?\s*(.*?)\s*$", predicate)
+        operator, operand = match.groups()
+        return operator or "=", operand
+
+    def __valueKey(self, value):
+        """Returns the text that a value is indexed under"""
+        if isinstance(value, basestring):
+            return value
+        return "%s" % value
+
+    def __numberOrNone(self, value):
+        """Returns a value as a float, or None if it isn't a number"""
+        try:
+            number = float(value)
+        except (ValueError, TypeError):
+            return None
+        if number != number:
+            # NaN can't be kept in sorted order
+            return None
+        return number
+
+class CellReferenceCodec(object):
+    """Converts between cell references (e.g. AB12) and (row, col), caching up to CELL_REFERENCE_CACHE_SIZE conversions"""
+    def __init__(self, numberCols = NUMBER_GRID_COLS):
+        # columnLabels[col] = label, columnIndexes[label] = col
+        self.columnLabels = []
+        self.columnIndexes = {}
+        # Interned conversions - identical references share one object
+        self.decodedReferences = {}
+        self.encodedCells = {}
+        self.__extendColumnTable(numberCols)
+
+    def clearCache(self):
+        """Forgets the cached conversions (the column table is kept)"""
+        self.decodedReferences = {}
+        self.encodedCells = {}
+
+    def __extendColumnTable(self, numberCols):
+        """Precomputes the labels of the first numberCols columns"""
+        for col in range(len(self.columnLabels), numberCols):
+            label = self.__computeColumnLabel(col)
+            self.columnLabels.append(label)
+            self.columnIndexes[label] = col
+
+    def __computeColumnLabel(self, col):
+        """Works out the label of a column (0 = A, 25 = Z, 26 = AA, ...)"""
+        label = ''
+        col += 1
+        while col > 0:
+            col, remainder = divmod(col - 1, 26)
+            label = chr(65 + remainder) + label
+        return label
+
+    def __computeColumnIndex(self, label):
+        """Works out the column of a label (A = 0, Z = 25, AA = 26, ...)"""
+        if not label:
+            raise ValueError("Empty column label")
+        col = 0
+        for letter in label:
+            letterValue = ord(letter) - 64
+            if letterValue < 1 or letterValue > 26:
+                raise ValueError("Bad column label '%s'" % label)
+            col = col * 26 + letterValue
+        return col - 1
+
+    def columnLabel(self, col):
+        """Returns the label of a column"""
+        if col >= len(self.columnLabels):
+            self.__extendColumnTable(max(col + 1, len(self.columnLabels) * 2))
+        return self.columnLabels[col]
+
+    def columnIndex(self, label):
+        """Returns the column of a label"""
+        col = self.columnIndexes.get(label)
+        if col is None:
+            # Labels outside the column table aren't cached, so odd references like ZZZZ1 don't build up
+            col = self.__computeColumnIndex(label)
+        return col
+
+    def isReference(self, reference):
+        """Returns the result of whether a string is a valid cell reference"""
+        try:
+            self.decode(reference)
+        except ValueError:
+            return False
+        return True
+
+    def decode(self, reference):
+        """Converts a cell reference (e.g. A1) into (row, col)"""
+        cell = self.decodedReferences.get(reference)
+        if cell is None:
+            cell = self.decodeOnce(reference)
+            if len(self.decodedReferences) >= CELL_REFERENCE_CACHE_SIZE:
+                self.decodedReferences = {}
+            self.decodedReferences[reference] = cell
+        return cell
+
+    def decodeOnce(self, reference):
+        """Converts a cell reference into (row, col) without caching it (for references that won't be seen again)"""
+        cell = self.decodedReferences.get(reference)
+        if cell is not None:
+            return cell
+        letters = reference.rstrip("0123456789")
+        digits = reference[len(letters):]
+        if not digits or int(digits) < 1:
+            raise ValueError("Bad cell reference '%s'" % reference)
+        return int(digits) - 1, self.columnIndex(letters)
+
+    def encode(self, row, col):
+        """Converts (row, col) into a cell reference (e.g. A1)"""
+        reference = self.encodedCells.get((row, col))
+        if reference is None:
+            reference = self.encodeOnce(row, col)
+            if len(self.encodedCells) >= CELL_REFERENCE_CACHE_SIZE:
+                self.encodedCells = {}
+            self.encodedCells[(row, col)] = reference
+        return reference
+
+    def encodeOnce(self, row, col):
+        """Converts (row, col) into a cell reference without caching it (for cells that won't be seen again)"""
+        reference = self.encodedCells.get((row, col))
+        if reference is not None:
+            return reference
+        return "%s%d" % (self.columnLabel(col), row + 1)
+
+    def decodeRange(self, cellRange):
+        """Converts a range (e.g. A1:C10, or a single cell) into (firstRow, firstCol, lastRow, lastCol)"""
+        references = cellRange.split(":")
+        if len(references) > 2:
+            raise ValueError("Bad range '%s'" % cellRange)
+        firstRow, firstCol = self.decode(references[0])
+        lastRow, lastCol = self.decode(references[-1])
+        return min(firstRow, lastRow), min(firstCol, lastCol), max(firstRow, lastRow), max(firstCol, lastCol)
+
+    def decodeAll(self, references):
+        """Converts a list of cell references into a list of (row, col)"""
+        decode = self.decode
+        return [decode(reference) for reference in references]
+
+    def encodeAll(self, cells):
+        """Converts a list of (row, col) into a list of cell references"""
+        encode = self.encode
+        return [encode(row, col) for (row, col) in cells]
+
+class ImportCancelled(Exception):
+    """Raised inside SeparatedFileReader when the user cancels an import"""
+    pass
+
+class SeparatedFileReader(object):
+    """Reads the rows of a separated file, reading and decompressing it on a background thread.
+
+    The source can be a file path, "-" for stdin or an http(s) URL, and can be
+    gzip, bz2 or xz compressed. The separator is detected if it isn't given.
+    If given, progress() is called after each batch and while waiting for data;
+    returning False from it cancels the import, keeping the rows read so far."""
+    def __init__(self, source, separator = None, progress = None):
+        self.source = source
+        self.separator = separator
+        self.progress = progress
+        self.cancelled = False
+        self.chunkQueue = Queue.Queue(IMPORT_QUEUE_SIZE)
+        self.stopEvent = threading.Event()
+
+    def rowBatches(self):
+        """Yields lists of rows (each row a list of values) while the background thread carries on reading"""
+        producer = threading.Thread(target = self.__produceChunks)
+        producer.setDaemon(True)
+        producer.start()
+        try:
+            lines = self.__linesFromChunks(self.__detectSeparator(self.__queuedChunks()))
+            batch = []
+            for row in csv.reader(lines, delimiter = self.separator):
+                batch.append(row)
+                if len(batch) == IMPORT_ROWS_PER_BATCH:
+                    yield batch
+                    batch = []
+                    if not self.__reportProgress():
+                        return
+            if batch:
+                yield batch
+        except ImportCancelled:
+            return
+        finally:
+            # Unblock the producer if the consumer stopped early
+            self.stopEvent.set()
+
+    def __queuedChunks(self):
+        """Yields the chunks queued by the background thread"""
+        while True:
+            try:
+                chunk = self.chunkQueue.get(True, IMPORT_POLL_INTERVAL)
+            except Queue.Empty:
+                if not self.__reportProgress():
+                    raise ImportCancelled()
+                continue
+            if chunk is None:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    def __reportProgress(self):
+        """Calls the progress callback, returning False (and marking the import cancelled) if it asks to stop"""
+        if self.progress is None or self.progress():
+            return True
+        self.cancelled = True
+        return False
+
+    def __produceChunks(self):
+        """Reads and decompresses the source, queueing chunks of text.
+        Parsing stays on the consumer's thread - reading and decompressing release the GIL, parsing doesn't."""
+        try:
+            sourceFile = self.__openSource()
+            try:
+                for chunk in self.__decompressedChunks(sourceFile):
+                    if not self.__queue(chunk):
+                        return
+            finally:
+                if sourceFile is not sys.stdin:
+                    sourceFile.close()
+        except Exception, e:
+            self.__queue(e)
+            return
+        self.__queue(None)
+
+    def __queue(self, item):
+        """Queues an item for the consumer, returning False if the consumer has stopped"""
+        while not self.stopEvent.isSet():
+            try:
+                self.chunkQueue.put(item, True, 0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def __openSource(self):
+        """Opens the source as a binary file-like object"""
+        if self.source == "-":
+            return sys.stdin
+        if re.match(r"https?://", self.source):
+            return urllib2.urlopen(self.source, timeout = IMPORT_URL_TIMEOUT)
+        return open(self.source, "rb")
+
+    def __decompressedChunks(self, sourceFile):
+        """Yields the source's contents in chunks, decompressing them if needed"""
+        chunk = sourceFile.read(IMPORT_CHUNK_SIZE)
+        compression = self.__detectCompression(chunk)
+        if compression is None:
+            while chunk:
+                yield chunk
+                chunk = sourceFile.read(IMPORT_CHUNK_SIZE)
+            return
+        decompressor = self.__newDecompressor(compression)
+        while chunk:
+            yield decompressor.decompress(chunk)
+            # Concatenated streams (e.g. pigz / pbzip2 output) start a new decompressor
+            while decompressor.unused_data:
+                unusedData = decompressor.unused_data
+                decompressor = self.__newDecompressor(compression)
+                yield decompressor.decompress(unusedData)
+            chunk = sourceFile.read(IMPORT_CHUNK_SIZE)
+
+    def __detectCompression(self, chunk):
+        """Returns the compression used by a file from its first bytes, or None"""
+        for signature, compression in COMPRESSION_SIGNATURES:
+            if chunk.startswith(signature):
+                return compression
+        return None
+
+    def __newDecompressor(self, compression):
+        """Creates a streaming decompressor"""
+        if compression == "gzip":
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if compression == "bz2":
+            return bz2.BZ2Decompressor()
+        if lzma is None:
+            raise IOError("xz files can't be imported - the lzma module isn't installed")
+        return lzma.LZMADecompressor()
+
+    def __detectSeparator(self, chunks):
+        """Sets self.separator from a sample of the data if it wasn't given, passing the chunks through"""
+        if self.separator is not None:
+            return chunks
+        sampleChunks = []
+        sampleSize = 0
+        for chunk in chunks:
+            sampleChunks.append(chunk)
+            sampleSize += len(chunk)
+            if sampleSize >= SEPARATOR_SAMPLE_SIZE:
+                break
+        sample = "".join(sampleChunks)[:SEPARATOR_SAMPLE_SIZE]
+        if "\n" in sample:
+            sample = sample[:sample.rindex("\n")]
+        try:
+            self.separator = csv.Sniffer().sniff(sample, SEPARATORS).delimiter
+        except csv.Error:
+            self.separator = ","
+        return self.__chainChunks(sampleChunks, chunks)
+
+    def __chainChunks(self, firstChunks, otherChunks):
+        """Yields the chunks already read followed by the rest"""
+        for chunk in firstChunks:
+            yield chunk
+        for chunk in otherChunks:
+            yield chunk
+
+    def __linesFromChunks(self, chunks):
+        """Splits chunks of text into lines, keeping the line endings"""
+        remainder = ""
+        for chunk in chunks:
+            if not chunk:
+                continue
+            lines = (remainder + chunk).split("\n")
+            remainder = lines.pop()
+            for line in lines:
+                yield line + "\n"
+        if remainder:
+            yield remainder
+
+class SpreadsheetFile(object):
+    """Base class for zipped XML spreadsheet files (xlsx and ods)"""
+    def __init__(self, filePath):
+        self.filePath = filePath
+        self.references = CellReferenceCodec()
+
+    def loadCells(self):
+        """Yields batches of (row, col, value) from the first sheet, with formulas pyXL supports as "=..." values"""
+        spreadsheetZip = zipfile.ZipFile(self.filePath)
+        try:
+            batch = []
+            for cell in self.readCells(spreadsheetZip):
+                batch.append(cell)
+                if len(batch) == IMPORT_CELLS_PER_BATCH:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+        finally:
+            spreadsheetZip.close()
+
+    def saveCells(self, cells):
+        """Saves a list of (row, col, value, formula) cells, sorted by row then col, as a single sheet.
+        The sheet is written to a temporary file first so it never has to be held in memory."""
+        sheetFile = tempfile.NamedTemporaryFile(delete = False)
+        try:
+            try:
+                self.writeSheet(sheetFile, cells)
+            finally:
+                sheetFile.close()
+            spreadsheetZip = zipfile.ZipFile(self.filePath, "w", zipfile.ZIP_DEFLATED)
+            try:
+                self.writeZip(spreadsheetZip, sheetFile.name)
+            finally:
+                spreadsheetZip.close()
+        finally:
+            os.remove(sheetFile.name)
+
+    def pyxlFormula(self, formula):
+        """Returns a formula in pyXL syntax (e.g. =A1+B1), or None if pyXL can't calculate it"""
+        formula = formula.replace("$", "").replace(" ", "")
+        if PYXL_FORMULA_PATTERN.match(formula):
+            return "=" + formula
+        return None
+
+    def xmlText(self, value):
+        """Returns a cell value as escaped UTF-8 text"""
+        if isinstance(value, unicode):
+            return escape(value.encode("utf-8"))
+        if isinstance(value, float):
+            return repr(value)
+        return escape("%s" % value)
+
+    def isNumber(self, value):
+        """Returns the result of whether a cell value should be saved as a number"""
+        if isinstance(value, (int, long, float)):
+            return True
+        return NUMBER_PATTERN.match(value) is not None
+
+class XlsxFile(SpreadsheetFile):
+    """An Excel workbook (.xlsx), read with iterparse and written a row at a time"""
+    def readCells(self, workbookZip):
+        """Yields (row, col, value) for each populated cell of the first worksheet"""
+        ns = "{%s}" % XLSX_NAMESPACE
+        sharedStrings = self.__loadSharedStrings(workbookZip)
+        cellTag = ns + "c"
+        rowTag = ns + "row"
+        sheetDataTag = ns + "sheetData"
+        sheetData = None
+        # Rows and cells without an r attribute follow on from the previous row or cell
+        rowNum = 0
+        colNum = -1
+        for event, element in ElementTree.iterparse(workbookZip.open(self.__firstSheetPath(workbookZip)), ("start", "end")):
+            if event == "start":
+                if element.tag == rowTag:
+                    rowReference = element.get("r")
+                    if rowReference:
+                        rowNum = int(rowReference) - 1
+                    colNum = -1
+                elif element.tag == sheetDataTag:
+                    sheetData = element
+                continue
+            if element.tag == cellTag:
+                reference = element.get("r")
+                if reference:
+                    rowNum, colNum = self.references.decodeOnce(reference)
+                else:
+                    colNum += 1
+                value = self.__cellValue(element, ns, sharedStrings)
+                if value:
+                    yield rowNum, colNum, value
+            elif element.tag == rowTag:
+                # Detach the finished row from <sheetData> so memory use doesn't grow with the sheet
+                element.clear()
+                if sheetData is not None:
+                    sheetData.remove(element)
+                rowNum += 1
+
+    def __cellValue(self, element, ns, sharedStrings):
+        """Returns the value of a <c> element"""
+        formulaElement = element.find(ns + "f")
+        if formulaElement is not None and formulaElement.text:
+            formula = self.pyxlFormula(formulaElement.text)
+            if formula:
+                return formula
+        cellType = element.get("t", "n")
+        if cellType == "inlineStr":
+            inlineString = element.find(ns + "is")
+            if inlineString is None:
+                return ""
+            return self.__joinText(inlineString, ns)
+        valueElement = element.find(ns + "v")
+        if valueElement is None or valueElement.text is None:
+            return ""
+        if cellType == "s":
+            return sharedStrings[int(valueElement.text)]
+        if cellType == "b":
+            if valueElement.text == "1":
+                return "TRUE"
+            return "FALSE"
+        return valueElement.text
+
+    def __joinText(self, element, ns):
+        """Joins the text of a string item (<si> or <is>), ignoring phonetic runs"""
+        textElements = element.findall(ns + "t") or element.findall(ns + "r/" + ns + "t")
+        return "".join(textElement.text or "" for textElement in textElements)
+
+    def __loadSharedStrings(self, workbookZip):
+        """Returns the workbook's shared string table as a list"""
+        ns = "{%s}" % XLSX_NAMESPACE
+        try:
+            stringsFile = workbookZip.open("xl/sharedStrings.xml")
+        except KeyError:
+            return []
+        sharedStrings = []
+        for event, element in ElementTree.iterparse(stringsFile):
+            if element.tag == ns + "si":
+                sharedStrings.append(self.__joinText(element, ns))
+                element.clear()
+        return sharedStrings
+
+    def __firstSheetPath(self, workbookZip):
+        """Returns the path inside the zip of the first worksheet"""
+        ns = "{%s}" % XLSX_NAMESPACE
+        try:
+            workbook = ElementTree.parse(workbookZip.open("xl/workbook.xml")).getroot()
+            relationshipId = workbook.find(ns + "sheets/" + ns + "sheet").get("{%s}id" % XLSX_RELATIONSHIPS_NAMESPACE)
+            relationships = ElementTree.parse(workbookZip.open("xl/_rels/workbook.xml.rels")).getroot()
+        except (KeyError, AttributeError):
+            return "xl/worksheets/sheet1.xml"
+        for relationship in relationships:
+            if relationship.get("Id") == relationshipId:
+                target = relationship.get("Target")
+                if target.startswith("/"):
+                    return target[1:]
+                return "xl/" + target
+        return "xl/worksheets/sheet1.xml"
+
+    def writeSheet(self, sheetFile, cells):
+        """Writes the worksheet XML"""
+        sheetFile.write('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<worksheet xmlns="%s"><sheetData>' % XLSX_NAMESPACE)
+        currentRow = None
+        for row, col, value, formula in cells:
+            if row != currentRow:
+                if currentRow is not None:
+                    sheetFile.write("</row>")
+                sheetFile.write('<row r="%d">' % (row + 1))
+                currentRow = row
+            sheetFile.write(self.__cellXml(row, col, value, formula))
+        if currentRow is not None:
+            sheetFile.write("</row>")
+        sheetFile.write("</sheetData></worksheet>")
+
+    def __cellXml(self, row, col, value, formula):
+        """Returns the <c> element for a cell"""
+        reference = self.references.encode(row, col)
+        if formula:
+            if self.isNumber(value):
+                return '<c r="%s"><f>%s</f><v>%s</v></c>' % (reference, escape(formula[1:]), self.xmlText(value))
+            return '<c r="%s" t="str"><f>%s</f><v>%s</v></c>' % (reference, escape(formula[1:]), self.xmlText(value))
+        if self.isNumber(value):
+            return '<c r="%s"><v>%s</v></c>' % (reference, self.xmlText(value))
+        return '<c r="%s" t="inlineStr"><is><t xml:space="preserve">%s</t></is></c>' % (reference, self.xmlText(value))
+
+    def writeZip(self, workbookZip, sheetPath):
+        """Adds the workbook parts to the zip"""
+        workbookZip.writestr("[Content_Types].xml",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            '</Types>')
+        workbookZip.writestr("_rels/.rels",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+            '</Relationships>')
+        workbookZip.writestr("xl/workbook.xml",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<workbook xmlns="%s" xmlns:r="%s"><sheets><sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets></workbook>'
+            % (XLSX_NAMESPACE, XLSX_RELATIONSHIPS_NAMESPACE))
+        workbookZip.writestr("xl/_rels/workbook.xml.rels",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+            '</Relationships>')
+        workbookZip.write(sheetPath, "xl/worksheets/sheet1.xml")
+
+class OdsFile(SpreadsheetFile):
+    """An OpenDocument spreadsheet (.ods), read with iterparse and written a row at a time"""
+    def readCells(self, spreadsheetZip):
+        """Yields (row, col, value) for each populated cell of the first table"""
+        table = "{%s}" % ODS_TABLE_NAMESPACE
+        rowNum = 0
+        colNum = 0
+        rowCells = []
+        tablesSeen = 0
+        # Rows may sit in a table, a row group or the header rows, so keep the chain of open elements
+        openElements = []
+        for event, element in ElementTree.iterparse(spreadsheetZip.open("content.xml"), ("start", "end")):
+            if event == "start":
+                openElements.append(element)
+                if element.tag == table + "table":
+                    tablesSeen += 1
+                elif element.tag == table + "table-row":
+                    colNum = 0
+                    rowCells = []
+                continue
+            openElements.pop()
+            if tablesSeen != 1:
+                if tablesSeen > 1:
+                    return
+                continue
+            if element.tag in (table + "table-cell", table + "covered-table-cell"):
+                repeat = int(element.get(table + "number-columns-repeated", "1"))
+                value = self.__cellValue(element)
+                if value:
+                    for offset in range(repeat):
+                        rowCells.append((colNum + offset, value))
+                colNum += repeat
+                element.clear()
+            elif element.tag == table + "table-row":
+                repeat = int(element.get(table + "number-rows-repeated", "1"))
+                if rowCells:
+                    for offset in range(repeat):
+                        for col, value in rowCells:
+                            yield rowNum + offset, col, value
+                rowNum += repeat
+                # Detach the finished row so memory use doesn't grow with the sheet
+                element.clear()
+                openElements[-1].remove(element)
+            elif element.tag == table + "table":
+                return
+
+    def __cellValue(self, element):
+        """Returns the value of a <table:table-cell> element"""
+        office = "{%s}" % ODS_OFFICE_NAMESPACE
+        formula = element.get("{%s}formula" % ODS_TABLE_NAMESPACE)
+        if formula:
+            formula = self.pyxlFormula(self.__fromOdsFormula(formula))
+            if formula:
+                return formula
+        valueType = element.get(office + "value-type")
+        if valueType in ("float", "percentage", "currency"):
+            return element.get(office + "value")
+        if valueType == "date":
+            return element.get(office + "date-value")
+        if valueType == "time":
+            return element.get(office + "time-value")
+        if valueType == "boolean":
+            return element.get(office + "boolean-value", "").upper()
+        paragraphs = element.findall("{%s}p" % ODS_TEXT_NAMESPACE)
+        return "\n".join("".join(paragraph.itertext()) for paragraph in paragraphs)
+
+    def __fromOdsFormula(self, formula):
+        """Converts an OpenFormula (e.g. of:=[.A1]+[.B1]) to A1+B1"""
+        if formula.startswith("of:"):
+            formula = formula[3:]
+        return re.sub(r"\[\.?([$A-Z]+[$0-9]+)\]", r"\1", formula.lstrip("="))
+
+    def __toOdsFormula(self, formula):
+        """Converts a pyXL formula (e.g. =A1+B1) to an OpenFormula"""
+        return "of:=" + CELL_REFERENCE_PATTERN.sub(lambda match: "[.%s]" % match.group(0), formula[1:])
+
+    def writeSheet(self, sheetFile, cells):
+        """Writes content.xml"""
+        lastCol = 0
+        for cell in cells:
+            lastCol = max(lastCol, cell[1])
+        sheetFile.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<office:document-content xmlns:office="%s" xmlns:table="%s" xmlns:text="%s" office:version="1.2">'
+            '<office:body><office:spreadsheet><table:table table:name="Sheet1">'
+            '<table:table-column table:number-columns-repeated="%d"/>'
+            % (ODS_OFFICE_NAMESPACE, ODS_TABLE_NAMESPACE, ODS_TEXT_NAMESPACE, lastCol + 1))
+        currentRow = -1
+        nextCol = 0
+        for row, col, value, formula in cells:
+            if row != currentRow:
+                if currentRow >= 0:
+                    sheetFile.write("</table:table-row>")
+                if row > currentRow + 1:
+                    sheetFile.write('<table:table-row table:number-rows-repeated="%d"><table:table-cell/></table:table-row>' % (row - currentRow - 1))
+                sheetFile.write("<table:table-row>")
+                currentRow = row
+                nextCol = 0
+            if col > nextCol:
+                sheetFile.write('<table:table-cell table:number-columns-repeated="%d"/>' % (col - nextCol))
+            sheetFile.write(self.__cellXml(value, formula))
+            nextCol = col + 1
+        if currentRow >= 0:
+            sheetFile.write("</table:table-row>")
+        sheetFile.write("</table:table></office:spreadsheet></office:body></office:document-content>")
+
+    def __cellXml(self, value, formula):
+        """Returns the <table:table-cell> element for a cell"""
+        text = self.xmlText(value)
+        formulaAttribute = ""
+        if formula:
+            formulaAttribute = " table:formula=%s" % quoteattr(self.__toOdsFormula(formula))
+        if self.isNumber(value):
+            return '<table:table-cell%s office:value-type="float" office:value="%s"><text:p>%s</text:p></table:table-cell>' % (formulaAttribute, text, text)
+        return '<table:table-cell%s office:value-type="string"><text:p>%s</text:p></table:table-cell>' % (formulaAttribute, text)
+
+    def writeZip(self, spreadsheetZip, sheetPath):
+        """Adds the document parts to the zip - mimetype must be first and uncompressed"""
+        spreadsheetZip.writestr(zipfile.ZipInfo("mimetype"), "application/vnd.oasis.opendocument.spreadsheet")
+        spreadsheetZip.writestr("META-INF/manifest.xml",
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<manifest:manifest xmlns:manifest="urn:oasis:names:tc:opendocument:xmlns:manifest:1.0" manifest:version="1.2">'
+            '<manifest:file-entry manifest:full-path="/" manifest:media-type="application/vnd.oasis.opendocument.spreadsheet"/>'
+            '<manifest:file-entry manifest:full-path="content.xml" manifest:media-type="text/xml"/>'
+            '</manifest:manifest>')
+        spreadsheetZip.write(sheetPath, "content.xml")
+
+class SheetSnapshot(object):
+    """A copy-on-write view of a DataTable as it was when the snapshot was taken.
+
+    Taking a snapshot copies nothing - the DataTable hands each cell's old value
+    and formula to its snapshots just before the cell first changes."""
+    def __init__(self, dataTable):
+        self.dataTable = dataTable
+        # savedCells = {(row, col): (value, formula)} - None for an empty cell / no formula
+        self.savedCells = {}
+        # Set when the DataTable is cleared and hands over its old dictionaries
+        self.frozenData = None
+        self.frozenFormulas = None
+        self.dependents = None
+        dataTable.snapshots.add(self)
+
+    def preserve(self, cell, value, formula):
+        """Keeps a cell's value and formula from before its first change"""
+        if cell not in self.savedCells:
+            self.savedCells[cell] = (value, formula)
+
+    def detach(self, data, formulas):
+        """Takes over the DataTable's old (no longer changing) dictionaries when it is cleared"""
+        self.frozenData = data
+        self.frozenFormulas = formulas
+
+    def __currentData(self):
+        """Returns the dictionary holding the cells that haven't been saved"""
+        if self.frozenData is not None:
+            return self.frozenData
+        return self.dataTable.data
+
+    def __currentFormulas(self):
+        """Returns the dictionary holding the formulas that haven't been saved"""
+        if self.frozenFormulas is not None:
+            return self.frozenFormulas
+        return self.dataTable.formulas
+
+    def getValue(self, row, col):
+        """Returns the value a cell had, or None if it was empty"""
+        savedCell = self.savedCells.get((row, col))
+        if savedCell is not None:
+            return savedCell[0]
+        return self.__currentData().get((row, col))
+
+    def getFormula(self, row, col):
+        """Returns the formula a cell had, or None"""
+        savedCell = self.savedCells.get((row, col))
+        if savedCell is not None:
+            return savedCell[1]
+        return self.__currentFormulas().get((row, col))
+
+    def formulaDependents(self):
+        """Returns {cell: set of formula cells that refer to it} as of the snapshot"""
+        if self.dependents is not None:
+            return self.dependents
+        currentFormulas = self.__currentFormulas()
+        if self.frozenFormulas is None:
+            formulasChanged = False
+            for cell, (value, formula) in self.savedCells.iteritems():
+                if currentFormulas.get(cell) != formula:
+                    formulasChanged = True
+                    break
+            if not formulasChanged:
+                # Same formulas as the live sheet, so share its (cached) dependents
+                return self.dataTable.formulaDependents()
+        formulas = dict(currentFormulas)
+        for cell, (value, formula) in self.savedCells.iteritems():
+            if formula is None:
+                formulas.pop(cell, None)
+            else:
+                formulas[cell] = formula
+        # The snapshot never changes, so neither do its dependents
+        self.dependents = self.dataTable.buildDependents(formulas)
+        return self.dependents
+
+class Scenario(object):
+    """A what-if version of a sheet that only stores the cells that differ from it.
+
+    The scenario is based on a SheetSnapshot, so later changes to the sheet don't
+    affect it. Changing a cell recalculates only the formulas that depend on it."""
+    def __init__(self, dataTable, name):
+        self.dataTable = dataTable
+        self.name = name
+        self.snapshot = SheetSnapshot(dataTable)
+        # overrides = {(row, col): text entered in the scenario}
+        # formulas = {(row, col): formula, or None to hide a formula from the snapshot}
+        # values = {(row, col): value of an overridden or recalculated cell, None if empty}
+        # extraDependents = {(row, col): set of scenario formula cells that refer to it}
+        self.overrides = {}
+        self.formulas = {}
+        self.values = {}
+        self.extraDependents = {}
+
+    def getValue(self, row, col):
+        """Gets the value of a cell in the scenario"""
+        cell = (row, col)
+        if cell in self.values:
+            value = self.values[cell]
+        else:
+            value = self.snapshot.getValue(row, col)
+        if value is None:
+            return ''
+        return value
+
+    def getBaseValue(self, row, col):
+        """Gets the value of a cell in the sheet the scenario was created from"""
+        value = self.snapshot.getValue(row, col)
+        if value is None:
+            return ''
+        return value
+
+    def getFormula(self, row, col):
+        """Returns the formula of a cell in the scenario, or None"""
+        cell = (row, col)
+        if cell in self.formulas:
+            return self.formulas[cell]
+        return self.snapshot.getFormula(row, col)
+
+    def setValue(self, row, col, value):
+        """Sets the value of a cell in the scenario"""
+        self.setValues({(row, col): value})
+
+    def setValues(self, cellValues):
+        """Sets several cells ({(row, col): text}) and recalculates their dependents once"""
+        for cell, value in cellValues.iteritems():
+            if value[:1] == "=" and not self.dataTable.isFormulaWellFormed(value):
+                # Kept as an error value, as the sheet does
+                value = "!ERR %s" % value
+            self.overrides[cell] = value
+            if value[:1] == "=":
+                self.formulas[cell] = value
+                for reference in self.dataTable.formulaReferences(value):
+                    self.extraDependents.setdefault(reference, set()).add(cell)
+            else:
+                self.formulas[cell] = None
+                self.values[cell] = value or None
+        self.__recalculate(cellValues.keys())
+
+    def changedCells(self):
+        """Returns a sorted list of the cells whose value differs from the sheet the scenario was created from"""
+        return sorted(cell for (cell, value) in self.values.iteritems() if value != self.snapshot.getValue(cell[0], cell[1]))
+
+    def __recalculate(self, changedCells):
+        """Recalculates the formulas that depend (directly or not) on changedCells, each after the cells it refers to"""
+        snapshotDependents = self.snapshot.formulaDependents()
+        affectedCells = set(cell for cell in changedCells if self.getFormula(cell[0], cell[1]))
+        uncheckedCells = list(changedCells)
+        while uncheckedCells:
+            cell = uncheckedCells.pop()
+            for dependents in (snapshotDependents.get(cell, ()), self.extraDependents.get(cell, ())):
+                for dependent in dependents:
+                    if dependent not in affectedCells and self.getFormula(dependent[0], dependent[1]):
+                        affectedCells.add(dependent)
+                        uncheckedCells.append(dependent)
+        # Each affected formula is calculated after the affected cells it refers to
+        affectedFormulas = dict((cell, self.getFormula(cell[0], cell[1])) for cell in affectedCells)
+        for cell in self.dataTable.dependencyOrder(affectedFormulas):
+            self.values[cell] = self.dataTable.evaluateFormula(self.getFormula(cell[0], cell[1]), self.getValue)
+
 #---wxPython objects (view)
 
 class DataTable(wx.grid.PyGridTableBase):
@@ -119,6 +1267,13 @@ class DataTable(wx.grid.PyGridTableBase):
         self.dataType = wx.grid.GRID_VALUE_STRING
         self.formulas = {}
         self.loadedFile = ''
+        self.cellIndex = CellIndex()
+        self.references = CellReferenceCodec()
+        self.dependents = None
+        self.formulaOrder = None
+        self.snapshots = weakref.WeakSet()
+        self.scenarios = {}
+        self.activeScenario = None
     
     def IsEmptyCell(self, row, col):
         """Returns a cells state"""
@@ -133,7 +1288,13 @@ class DataTable(wx.grid.PyGridTableBase):
         return NUMBER_GRID_COLS
     
     def GetValue(self, row, col):
-        """Gets the value held in a specified cell"""
+        """Gets the value held in a specified cell (in the active scenario, if there is one)"""
+        if self.activeScenario is not None:
+            return self.activeScenario.getValue(row, col)
+        return self.getBaseValue(row, col)
+
+    def getBaseValue(self, row, col):
+        """Gets the value held in a specified cell of the sheet itself"""
         value = self.data.get((row, col))
         if value is not None:
             return value
@@ -142,37 +1303,419 @@ class DataTable(wx.grid.PyGridTableBase):
         
     def SetValue(self, row, col, value):
         """Sets the value held in a specified cell"""
+        if self.activeScenario is not None:
+            self.activeScenario.setValue(row, col, value)
+            return
         # See if value is a formula
         if len(value) == 0: # i.e. cell has been deleted
-            del self.data[(row, col)]
-            try:
-                del self.formulas[(row,col)]
-            except KeyError:
-                return
+            self.__storeValue(row, col, None)
+            self.__storeFormula(row, col, None)
             return
+        self.__setBaseValue(row, col, value)
+
+    def __setBaseValue(self, row, col, value):
+        """Sets a non-empty value in the sheet itself, calculating it if it is a formula"""
         if (value[0]) == "=":
             splitFormula = self.__breakdownFormula(value)
-            if (self.__isFormulaValid(splitFormula)):
-                self.data[(row, col)]  = self.__calculateFormula(row, col, splitFormula)
-                self.formulas[(row,col)] = value
+            if (self.__isFormulaValid(splitFormula, self.getBaseValue)):
+                self.__storeValue(row, col, self.__calculateOrError(value, splitFormula, self.getBaseValue))
+                self.__storeFormula(row, col, value)
             else:
-                self.data[(row, col)] = "!ERR %s" % value
+                self.__storeValue(row, col, "!ERR %s" % value)
+                self.__storeFormula(row, col, None)
+        else:
+            self.__storeValue(row, col, value)
+            self.__storeFormula(row, col, None)
+
+    def __storeValue(self, row, col, value):
+        """Stores a value in self.data and keeps the cell index up to date (a value of None clears the cell)"""
+        oldValue = self.data.get((row, col))
+        if oldValue is not None:
+            if value is not None and oldValue == value and type(oldValue) is type(value):
+                return
+            self.cellIndex.remove(row, col, oldValue)
+        elif value is None:
+            return
+        self.__preserveForSnapshots(row, col)
+        if value is None:
+            self.data.pop((row, col), None)
         else:
             self.data[(row, col)] = value
+            self.cellIndex.add(row, col, value)
+
+    def __storeFormula(self, row, col, formula):
+        """Stores the formula for a cell (a formula of None removes it)"""
+        if self.formulas.get((row, col)) == formula:
+            return
+        self.__preserveForSnapshots(row, col)
+        if formula is None:
+            del self.formulas[(row, col)]
+        else:
+            self.formulas[(row, col)] = formula
+        self.dependents = None
+        self.formulaOrder = None
+
+    def __preserveForSnapshots(self, row, col):
+        """Gives a cell's current value and formula to any snapshots before it changes"""
+        if len(self.snapshots):
+            cell = (row, col)
+            value = self.data.get(cell)
+            formula = self.formulas.get(cell)
+            for snapshot in self.snapshots:
+                snapshot.preserve(cell, value, formula)
+
+    def __detachSnapshots(self):
+        """Hands the current dictionaries over to any snapshots before they are replaced"""
+        for snapshot in self.snapshots:
+            snapshot.detach(self.data, self.formulas)
+        self.snapshots = weakref.WeakSet()
     
+    def Clear(self):
+        """Clears all cells (called by Grid.ClearGrid)"""
+        self.__detachSnapshots()
+        self.data = {}
+        self.formulas = {}
+        self.dependents = None
+        self.formulaOrder = None
+        self.scenarios = {}
+        self.activeScenario = None
+        self.cellIndex.reInitialise()
+        self.references.clearCache()
+
+    def setRows(self, rowBatches, firstRow = 0):
+        """Stores batches of rows (lists of values) starting at firstRow and returns the number of rows stored"""
+        rowNum = firstRow
+        formulaCells = {}
+        # The cycle collector keeps rescanning the growing model during bulk loads
+        gcWasEnabled = gc.isenabled()
+        gc.disable()
+        self.cellIndex.startBulkUpdate()
+        try:
+            for batch in rowBatches:
+                for line in batch:
+                    colNum = 0
+                    for value in line:
+                        value = value.strip(" ")
+                        if value:
+                            if value[0] == "=":
+                                # Calculated once every row is in, as it may refer to later rows
+                                formulaCells[(rowNum, colNum)] = value
+                            else:
+                                self.__storeValue(rowNum, colNum, value)
+                        colNum += 1
+                    rowNum += 1
+            self.__setFormulas(formulaCells)
+        finally:
+            self.cellIndex.finishBulkUpdate()
+            if gcWasEnabled:
+                gc.enable()
+        return rowNum - firstRow
+
+    def setCells(self, cellBatches):
+        """Stores batches of (row, col, value) cells, calculating formulas once every other value is in place.
+        Returns the number of cells stored."""
+        formulaCells = {}
+        storedCount = 0
+        gcWasEnabled = gc.isenabled()
+        gc.disable()
+        self.cellIndex.startBulkUpdate()
+        try:
+            for batch in cellBatches:
+                for row, col, value in batch:
+                    if value[0] == "=":
+                        formulaCells[(row, col)] = value
+                    else:
+                        self.__storeValue(row, col, value)
+                    storedCount += 1
+            self.__setFormulas(formulaCells)
+        finally:
+            self.cellIndex.finishBulkUpdate()
+            if gcWasEnabled:
+                gc.enable()
+        return storedCount
+
+    def __setFormulas(self, formulaCells):
+        """Sets formula cells ({(row, col): formula}), each after the formula cells it refers to"""
+        for row, col in self.dependencyOrder(formulaCells):
+            self.__setBaseValue(row, col, formulaCells[(row, col)])
+
+    def populatedCells(self):
+        """Returns a list of (row, col, value, formula) for every populated cell, sorted by row then col"""
+        return [(row, col, self.data[(row, col)], self.formulas.get((row, col))) for (row, col) in sorted(self.data)]
+
     def reInitialise(self):
         """Re-initialises the grid"""
+        self.__detachSnapshots()
         self.data = {}
         self.formulas = {}
         self.loadedFile = {}
+        self.dependents = None
+        self.formulaOrder = None
+        self.scenarios = {}
+        self.activeScenario = None
+        self.cellIndex.reInitialise()
+        self.references.clearCache()
+
+    def createScenario(self, name):
+        """Creates a what-if scenario from the sheet as it is now"""
+        scenario = Scenario(self, name)
+        self.scenarios[name] = scenario
+        return scenario
+
+    def setActiveScenario(self, name):
+        """Shows and edits a scenario in the grid instead of the sheet (a name of None goes back to the sheet)"""
+        if name is None:
+            self.activeScenario = None
+        else:
+            self.activeScenario = self.scenarios[name]
+
+    def deleteScenario(self, name):
+        """Deletes a scenario"""
+        if self.activeScenario is self.scenarios[name]:
+            self.activeScenario = None
+        del self.scenarios[name]
+
+    def compareScenarios(self, names):
+        """Returns [(row, col, value in the sheet, [value in each scenario])] for every cell changed by any of the scenarios.
+        The sheet values are those the first scenario was created from."""
+        scenarios = [self.scenarios[name] for name in names]
+        changedCells = set()
+        for scenario in scenarios:
+            changedCells.update(scenario.changedCells())
+        comparison = []
+        for row, col in sorted(changedCells):
+            comparison.append((row, col, scenarios[0].getBaseValue(row, col), [scenario.getValue(row, col) for scenario in scenarios]))
+        return comparison
+
+    def scenarioCells(self):
+        """Returns a list of (name, row, col, value) for the cells entered in each scenario"""
+        scenarioList = []
+        for name, scenario in sorted(self.scenarios.iteritems()):
+            for (row, col), value in sorted(scenario.overrides.iteritems()):
+                scenarioList.append((name, row, col, value))
+        return scenarioList
+
+    def scenarioBaseCells(self):
+        """Returns a list of (name, row, col, value, formula) for the cells each scenario was created from that
+        have since changed in the sheet (a value of None is an empty cell)"""
+        baseList = []
+        for name, scenario in sorted(self.scenarios.iteritems()):
+            for (row, col), (value, formula) in sorted(scenario.snapshot.savedCells.iteritems()):
+                if value != self.data.get((row, col)) or formula != self.formulas.get((row, col)):
+                    baseList.append((name, row, col, value, formula))
+        return baseList
+
+    def loadScenarios(self, scenarioList, baseList = ()):
+        """Creates scenarios from a list of (name, row, col, value) entered cells and a list of
+        (name, row, col, value, formula) cells of the sheet they were created from that differ from it now"""
+        scenarioValues = {}
+        for name, row, col, value in scenarioList:
+            scenarioValues.setdefault(name, {})[(row, col)] = "%s" % value
+        baseCells = {}
+        for name, row, col, value, formula in baseList:
+            baseCells.setdefault(name, []).append(((row, col), value, formula))
+        for name in set(scenarioValues) | set(baseCells):
+            scenario = self.createScenario(name)
+            for cell, value, formula in baseCells.get(name, ()):
+                scenario.snapshot.preserve(cell, value, formula)
+            scenario.setValues(scenarioValues.get(name, {}))
+
+    def formulaDependents(self):
+        """Returns {cell: set of formula cells that refer to it} for the sheet's formulas"""
+        if self.dependents is None:
+            self.dependents = self.buildDependents(self.formulas)
+        return self.dependents
+
+    def buildDependents(self, formulas):
+        """Returns {cell: set of formula cells that refer to it} for a dictionary of formulas"""
+        dependents = {}
+        for cell, formula in formulas.iteritems():
+            for reference in self.formulaReferences(formula):
+                cellDependents = dependents.get(reference)
+                if cellDependents is None:
+                    cellDependents = dependents[reference] = set()
+                cellDependents.add(cell)
+        return dependents
+
+    def formulaReferences(self, formula):
+        """Returns the cells a formula refers to, ignoring anything that isn't a valid cell reference (e.g. A0)"""
+        references = self.references
+        return [references.decode(reference) for reference in CELL_REFERENCE_PATTERN.findall(formula) if references.isReference(reference)]
+
+    def dependencyOrder(self, formulas):
+        """Returns the cells of a dictionary of formulas ordered so that each comes after the formula cells it refers to.
+        Cells in a circular reference come last, in no particular order."""
+        referenceCounts = {}
+        dependentsOf = {}
+        for cell, formula in formulas.iteritems():
+            cellReferences = set(reference for reference in self.formulaReferences(formula) if reference in formulas)
+            cellReferences.discard(cell)
+            referenceCounts[cell] = len(cellReferences)
+            for reference in cellReferences:
+                dependentsOf.setdefault(reference, []).append(cell)
+        readyCells = [cell for (cell, count) in referenceCounts.iteritems() if count == 0]
+        orderedCells = []
+        while readyCells:
+            cell = readyCells.pop()
+            orderedCells.append(cell)
+            for dependent in dependentsOf.get(cell, ()):
+                referenceCounts[dependent] -= 1
+                if referenceCounts[dependent] == 0:
+                    readyCells.append(dependent)
+        orderedCells.extend(cell for (cell, count) in referenceCounts.iteritems() if count > 0)
+        return orderedCells
+
+    def isFormulaWellFormed(self, formula):
+        """Returns the result of whether a formula is made of valid cell references and operators, whatever the cells hold"""
+        operands, operators = self.__splitIntoOperandsAndOperators(self.__breakdownFormula(formula))
+        return self.__checkNumberOfSplits(operands, operators) and self.__checkOperands(operands) and self.__checkOperators(operators)
+
+    def evaluateFormula(self, formula, getValue):
+        """Calculates a formula, reading cells through getValue(row, col), and returns the result or an error string"""
+        splitFormula = self.__breakdownFormula(formula)
+        if (self.__isFormulaValid(splitFormula, getValue)):
+            return self.__calculateOrError(formula, splitFormula, getValue)
+        return "!ERR %s" % formula
+
+    def findCells(self, text, matchWholeCell=True):
+        """Returns a row-ordered list of (row, col) for the cells whose value matches text"""
+        return self.cellIndex.findCells(text, matchWholeCell)
+
+    def findNextCell(self, text, row, col, matchWholeCell=True):
+        """Returns the first matching cell after (row, col), wrapping round to the top, or None"""
+        cells = self.cellIndex.findCells(text, matchWholeCell)
+        if not cells:
+            return None
+        position = bisect.bisect_right(cells, (row, col))
+        if position == len(cells):
+            position = 0
+        return cells[position]
+
+    def filterColumn(self, col, predicate):
+        """Returns a sorted list of the rows whose value in col matches a predicate (e.g. "> 100")"""
+        return self.cellIndex.filterColumn(col, predicate)
+
+    def replaceAll(self, findText, replaceText, matchWholeCell=True):
+        """Replaces findText with replaceText in every non-formula cell, recalculates once and returns the number of cells changed"""
+        replacedCount = 0
+        self.cellIndex.startBulkUpdate()
+        try:
+            for (row, col) in self.cellIndex.findCells(findText, matchWholeCell):
+                if (row, col) in self.formulas:
+                    continue
+                if matchWholeCell:
+                    newValue = replaceText
+                else:
+                    newValue = ("%s" % self.data[(row, col)]).replace(findText, replaceText)
+                self.__storeValue(row, col, newValue or None)
+                replacedCount += 1
+            if replacedCount:
+                self.refreshFormulas()
+        finally:
+            self.cellIndex.finishBulkUpdate()
+        return replacedCount
+
+    def getLastPopulatedCell(self):
+        """Returns (row, col) of the bottom-right corner of the populated area, or None if the sheet is empty"""
+        if not self.data:
+            return None
+        return max(row for (row, col) in self.data), max(col for (row, col) in self.data)
+
+    def parseSortKeys(self, sortText):
+        """Converts text such as "B, A desc" into a list of (col, ascending) sort keys"""
+        sortKeys = []
+        for sortColumn in sortText.split(","):
+            match = re.match(r"\s*([A-Za-z]+)(?:\s+(asc|desc))?\s*$", sortColumn, re.IGNORECASE)
+            if match is None:
+                raise ValueError("Bad sort column '%s'" % sortColumn.strip())
+            col = self.references.columnIndex(match.group(1).upper())
+            ascending = (match.group(2) or "asc").lower() == "asc"
+            sortKeys.append((col, ascending))
+        return sortKeys
+
+    def sortRows(self, firstRow, lastRow, firstCol, lastCol, sortKeys):
+        """Sorts the block of cells between (firstRow, firstCol) and (lastRow, lastCol) by rows, using sortKeys
+        (a list of (col, ascending), most significant first). Returns True if any rows moved."""
+        # The sort keys and moved cells are many small objects that the cycle collector would keep rescanning
+        gcWasEnabled = gc.isenabled()
+        gc.disable()
+        try:
+            rows = range(firstRow, lastRow + 1)
+            sortedRows = list(rows)
+            # Stable sort on each key in turn, least significant first
+            for col, ascending in reversed(sortKeys):
+                sortedRows.sort(key=lambda row: self.__sortKey(self.data.get((row, col)), ascending), reverse=not ascending)
+            newRowForOldRow = {}
+            for position, oldRow in enumerate(sortedRows):
+                if oldRow != firstRow + position:
+                    newRowForOldRow[oldRow] = firstRow + position
+            if not newRowForOldRow:
+                return False
+            self.__moveRows(newRowForOldRow, firstCol, lastCol)
+            self.refreshFormulas()
+        finally:
+            if gcWasEnabled:
+                gc.enable()
+        return True
+
+    def __sortKey(self, value, ascending):
+        """Returns the sort key for a value - numbers before text, empty cells always last"""
+        if value is None:
+            if ascending:
+                return (2,)
+            return (-1,)
+        if self.isStringFloat(value) is not False:
+            number = float(value)
+            if number == number:
+                return (0, number)
+        return (1, ("%s" % value).lower())
+
+    def __moveRows(self, newRowForOldRow, firstCol, lastCol):
+        """Moves the cells of rows within the columns firstCol..lastCol and points formula references at their new rows"""
+        cols = range(firstCol, lastCol + 1)
+        data = self.data
+        formulas = self.formulas
+        if len(self.snapshots):
+            for row in newRowForOldRow:
+                for col in cols:
+                    self.__preserveForSnapshots(row, col)
+        # Take each column's part of the block out in one pass, put it back permuted and re-index it together
+        rowMoves = newRowForOldRow.items()
+        for col in cols:
+            movedValues = [(oldRow, newRow, data.pop((oldRow, col))) for (oldRow, newRow) in rowMoves if (oldRow, col) in data]
+            data.update([((newRow, col), value) for (oldRow, newRow, value) in movedValues])
+            self.cellIndex.moveRows(col, movedValues)
+            if formulas:
+                movedFormulas = [(newRow, formulas.pop((oldRow, col))) for (oldRow, newRow) in rowMoves if (oldRow, col) in formulas]
+                formulas.update([((newRow, col), formula) for (newRow, formula) in movedFormulas])
+        self.dependents = None
+        self.formulaOrder = None
+
+        def rewriteReference(match):
+            row, col = self.references.decodeOnce(match.group(0))
+            if firstCol <= col <= lastCol and row in newRowForOldRow:
+                return self.references.encodeOnce(newRowForOldRow[row], col)
+            return match.group(0)
+        for cell, formula in self.formulas.items():
+            self.__storeFormula(cell[0], cell[1], CELL_REFERENCE_PATTERN.sub(rewriteReference, formula))
     
     def getFormula(self, row, col):
         """Returns the value of a formula if available"""
+        if self.activeScenario is not None:
+            return self.activeScenario.getFormula(row, col)
         try:
             return self.formulas[(row, col)] or True
         except (KeyError):
             return None
        
+    def GetColLabelValue(self, col):
+        """Returns the label shown above a column"""
+        return self.references.columnLabel(col)
+
+    def GetRowLabelValue(self, row):
+        """Returns the label shown beside a row"""
+        return "%d" % (row + 1)
+
     def GetTypeName(self, row, col):
         """Returns the datatype of the cell"""
         return self.dataType
@@ -195,16 +1738,16 @@ class DataTable(wx.grid.PyGridTableBase):
         """Breaks down a passed formula into two operands and an operator"""
         return re.findall(r"[\w']+|[+-/\*]", formula)
     
-    def __isFormulaValid(self, splitFormula):
+    def __isFormulaValid(self, splitFormula, getValue):
         """Checks to see if the entered formula is valid"""
         operands, operators = self.__splitIntoOperandsAndOperators(splitFormula)
-        if not(self.__checkNumberOfSplits):
+        if not(self.__checkNumberOfSplits(operands, operators)):
             return False
         if not(self.__checkOperands(operands)):
             return False
         if not(self.__checkOperators(operators)):
             return False
-        if not(self.__checkOperandGridValuesValid(operands)):
+        if not(self.__checkOperandGridValuesValid(operands, getValue)):
             return False
         return True
     
@@ -231,53 +1774,60 @@ class DataTable(wx.grid.PyGridTableBase):
     def __checkOperands(self, operands):
         """Checks the formula operands"""
         for value in operands:
-            # Split operand into letters and numbers
-            splitValue = re.findall(r"[A-Z]+|[0-9]+", value)
-            if len(splitValue) == 2:
-                return True
-            else:
+            if not self.references.isReference(value):
                 return False
+        return True
     
     def __checkOperators(self, operators):
         """Checks the formula operators"""
         for value in operators:
             splitValue = re.findall(r"[+-/\*]", value)
-            if len(splitValue) == 1:
-                return True
-            else:
+            if len(splitValue) != 1:
                 return False
+        return True
     
-    def __checkOperandGridValuesValid(self, operands):
+    def __checkOperandGridValuesValid(self, operands, getValue):
         """Checks that the values contained in the cellReference are valid"""
         for operand in operands:
-            row, col = self.__convertCellReferenceIntoRowAndCol(operand)
-            if (self.isInt(row, col) or self.isFloat(row, col)):
-                return True
-            else:
+            row, col = self.references.decode(operand)
+            value = getValue(row, col)
+            if not (self.isStringInt(value) or self.isStringFloat(value)):
                 return False
+        return True
     
     def refreshFormulas(self):
-        """Refreshes all the formulas in the data"""
-        for cell, value in self.formulas.iteritems():
+        """Refreshes all the formulas in the data, each after the formula cells it refers to"""
+        if self.formulaOrder is None:
+            self.formulaOrder = self.dependencyOrder(self.formulas)
+        for cell in self.formulaOrder:
+            value = self.formulas[cell]
             splitFormula = self.__breakdownFormula(value)
-            if (self.__isFormulaValid(splitFormula)):
-                self.data[(cell[0], cell[1])] = self.__calculateFormula(cell[0], cell[1], splitFormula)
+            if (self.__isFormulaValid(splitFormula, self.getBaseValue)):
+                self.__storeValue(cell[0], cell[1], self.__calculateOrError(value, splitFormula, self.getBaseValue))
             else:
-                self.data[cell] = "!ERR %s" % value
+                self.__storeValue(cell[0], cell[1], "!ERR %s" % value)
 
-    def __calculateFormula(self, row, col, splitFormula):
-        """Calculates the result of a formula and updates the self.data attribute"""
+    def __calculateOrError(self, formula, splitFormula, getValue):
+        """Calculates a valid formula, returning an error string if it can't be calculated (e.g. division by zero)"""
+        try:
+            return self.__calculateFormula(0, 0, splitFormula, getValue)
+        except (ValueError, ArithmeticError), e:
+            return "!ERR %s" % formula
+
+    def __calculateFormula(self, row, col, splitFormula, getValue):
+        """Calculates the result of a formula, reading cells through getValue(row, col)"""
         operatorPosition = 0
         operandPosition = 0
         runningTotal = 0
         operands, operators = self.__splitIntoOperandsAndOperators(splitFormula)
-        row, col = self.__convertCellReferenceIntoRowAndCol(operands[operandPosition])
+        operandCells = self.references.decodeAll(operands)
+        row, col = operandCells[operandPosition]
         operandPosition += 1
-        operandValue = self.data.get((row, col))
+        operandValue = getValue(row, col)
         runningTotal = self.__numberType(operandValue)
         for allOperands in range(len(operands) - 1):
-            row, col = self.__convertCellReferenceIntoRowAndCol(operands[operandPosition])
-            operandValue = self.GetValue(row, col)
+            row, col = operandCells[operandPosition]
+            operandValue = getValue(row, col)
             operandTwo = operands[(operandPosition)]
             if operators[operatorPosition] == "+":
                 runningTotal += self.__numberType(operandValue)
@@ -291,18 +1841,14 @@ class DataTable(wx.grid.PyGridTableBase):
             operandPosition += 1
         return runningTotal
     
-    # Pre-condition: stringNumber must be a number in string format
     def __numberType(self, stringNumber):
-        """Converts a string in to either a float or an int"""
+        """Converts a string in to either a float or an int (raises ValueError if it isn't a number)"""
         if self.isStringInt(stringNumber):
             return int(stringNumber)
         elif self.isStringFloat(stringNumber):
             return float(stringNumber)
         else:
-            print "Error in DataTable.__numberType - input parameter not a number in string form"
-            print stringNumber
-            print type(stringNumber)
-            sys.exit()
+            raise ValueError("'%s' is not a number" % stringNumber)
     
     def isStringFloat(self, stringNumber):
         """Returns the result of whether a string contains a float value"""
@@ -317,27 +1863,6 @@ class DataTable(wx.grid.PyGridTableBase):
             return int(stringNumber) or True
         except (ValueError, TypeError), e:
             return False
-    
-    def __convertCellReferenceIntoRowAndCol(self, cellReference):
-        """Converts a cell reference (e.g. A1) into row and col"""
-        splitReference = re.findall(r"[A-Z]+|[0-9]+", cellReference)
-        col = self.__convertLetterToCol(splitReference[0])
-        row = int(splitReference[1]) - 1
-        return row, col
-
-    def __convertLetterToCol(self, letter):
-        """Converts a column letter to a col number"""
-        splitLetter = re.findall(r"[A-Z]", letter)
-        if len(splitLetter) == 1:
-            numberLetter = ord(letter)
-            return numberLetter - 65
-        else:
-            total = 0
-            multiplier = ord(splitLetter[0]) - 65
-            total = multiplier * 26
-            secondLetterValue = ord(splitLetter[1])
-            total += total + (secondLetterValue - 1)
-            return total
 
 class SpreadsheetPrinter(HtmlEasyPrinting):
     def __init__(self):
@@ -355,6 +1880,7 @@ class MainFrame(wx.Frame):
     """Main frame of the spreadsheet"""
     def __init__(self, parent, id, title):
         self.loadedDatabase = ''
+        self.lastFindText = ''
         wx.Frame.__init__(self, parent, id, title, size=(934,619), style = wx.DEFAULT_FRAME_STYLE | wx.TAB_TRAVERSAL)
 
         # Setup frame
@@ -372,6 +1898,8 @@ class MainFrame(wx.Frame):
         """Creates the main page menu"""
         # Setup layout, menubar and toolbar
         self.__createFileMenu()
+        self.__createEditMenu()
+        self.__createScenarioMenu()
         self.__createHelpMenu()
         self.__completeMenuBarSetup()
         
@@ -385,18 +1913,50 @@ class MainFrame(wx.Frame):
         self.saveAsSheet = self.mainFileMenu.Append(-1, "&Save as...", "Save as the current sheet")
         self.mainFileMenu.AppendSeparator()
         self.importMenu = wx.Menu()
+        self.importAny = self.importMenu.Append(-1, "&Any separated file...", "Import a separated file, detecting the separator (compressed files are supported)")
+        self.importUrl = self.importMenu.Append(-1, "From &URL...", "Import a separated file from a URL")
+        self.importMenu.AppendSeparator()
         self.importCsv = self.importMenu.Append(-1, "&CSV", "Import from a CSV file")
         self.importSpace = self.importMenu.Append(-1, "&Space-separated", "Import from a space-separated file")
         self.importTab = self.importMenu.Append(-1, "&Tab-separated", "Import from a tab-separated file")
         self.importSemicolon = self.importMenu.Append(-1, "&Semicolon-separated", "Import from a semicolon-separated file")
+        self.importMenu.AppendSeparator()
+        self.importXlsx = self.importMenu.Append(-1, "&Excel workbook (xlsx)...", "Import the first sheet of an Excel workbook")
+        self.importOds = self.importMenu.Append(-1, "&OpenDocument spreadsheet (ods)...", "Import the first sheet of an OpenDocument spreadsheet")
         self.mainFileMenu.AppendMenu(-1, "&Import file", self.importMenu)
         self.exportCsv = self.mainFileMenu.Append(-1, "&Export to CSV", "Export to a CSV file")
+        self.exportXlsx = self.mainFileMenu.Append(-1, "Export to &XLSX", "Export to an Excel workbook")
+        self.exportOds = self.mainFileMenu.Append(-1, "Export to &ODS", "Export to an OpenDocument spreadsheet")
         self.mainFileMenu.AppendSeparator()
         self.printMenu = self.mainFileMenu.Append(-1, "&Print", "Prints sheet")
         self.printPreviewMenu = self.mainFileMenu.Append(-1, "P&rint preview", "Print preview")
         self.mainFileMenu.AppendSeparator()
         self.exitProg = self.mainFileMenu.Append(-1, "E&xit", "Exit")
         
+    def __createEditMenu(self):
+        """Creates the main page edit menu"""
+        self.mainEditMenu = wx.Menu()
+        self.findMenu = self.mainEditMenu.Append(-1, "&Find...", "Find a value in the sheet")
+        self.findNextMenu = self.mainEditMenu.Append(-1, "Find &next", "Find the next cell with the same value")
+        self.findAllMenu = self.mainEditMenu.Append(-1, "Find &all...", "Select every cell with a value")
+        self.replaceAllMenu = self.mainEditMenu.Append(-1, "&Replace all...", "Replace a value throughout the sheet")
+        self.mainEditMenu.AppendSeparator()
+        self.filterMenu = self.mainEditMenu.Append(-1, "F&ilter column...", "Only show rows matching a filter on the current column")
+        self.clearFilterMenu = self.mainEditMenu.Append(-1, "&Clear filter", "Show all rows")
+        self.mainEditMenu.AppendSeparator()
+        self.sortAscendingMenu = self.mainEditMenu.Append(-1, "Sort a&scending", "Sort rows by the current column, smallest first")
+        self.sortDescendingMenu = self.mainEditMenu.Append(-1, "Sort &descending", "Sort rows by the current column, largest first")
+        self.sortByMenu = self.mainEditMenu.Append(-1, "Sort &by...", "Sort rows by one or more columns")
+
+    def __createScenarioMenu(self):
+        """Creates the main page scenario menu"""
+        self.mainScenarioMenu = wx.Menu()
+        self.newScenarioMenu = self.mainScenarioMenu.Append(-1, "&New scenario...", "Create a what-if scenario from the current sheet")
+        self.switchScenarioMenu = self.mainScenarioMenu.Append(-1, "&Switch to...", "Show a scenario, or the sheet itself, in the grid")
+        self.compareScenariosMenu = self.mainScenarioMenu.Append(-1, "&Compare", "Compare the cells changed by each scenario")
+        self.mainScenarioMenu.AppendSeparator()
+        self.deleteScenarioMenu = self.mainScenarioMenu.Append(-1, "&Delete...", "Delete a scenario")
+
     def __createHelpMenu(self):
         """Creates the main page help menu"""
         self.mainHelpMenu = wx.Menu()
@@ -408,6 +1968,8 @@ class MainFrame(wx.Frame):
         """Completes the setup of the main menu bar"""
         self.mainMenuBar = wx.MenuBar(0)
         self.mainMenuBar.Append(self.mainFileMenu, "&File")
+        self.mainMenuBar.Append(self.mainEditMenu, "&Edit")
+        self.mainMenuBar.Append(self.mainScenarioMenu, "&Scenarios")
         self.mainMenuBar.Append(self.mainHelpMenu, "&Help")
         self.SetMenuBar(self.mainMenuBar)
 
@@ -508,14 +2070,33 @@ class MainFrame(wx.Frame):
         self.Bind(wx.EVT_MENU, self.__OnOpen, self.openSheet)
         self.Bind(wx.EVT_MENU, self.__OnSave, self.saveSheet)
         self.Bind(wx.EVT_MENU, self.__onSaveAs, self.saveAsSheet)
+        self.Bind(wx.EVT_MENU, self.__importAny, self.importAny)
+        self.Bind(wx.EVT_MENU, self.__importUrl, self.importUrl)
         self.Bind(wx.EVT_MENU, self.__importCsv, self.importCsv)
         self.Bind(wx.EVT_MENU, self.__importSpace, self.importSpace)
         self.Bind(wx.EVT_MENU, self.__importTab, self.importTab)
         self.Bind(wx.EVT_MENU, self.__importSemicolon, self.importSemicolon)
+        self.Bind(wx.EVT_MENU, self.__importXlsx, self.importXlsx)
+        self.Bind(wx.EVT_MENU, self.__importOds, self.importOds)
         self.Bind(wx.EVT_MENU, self.__exportCsv, self.exportCsv)
+        self.Bind(wx.EVT_MENU, self.__exportXlsx, self.exportXlsx)
+        self.Bind(wx.EVT_MENU, self.__exportOds, self.exportOds)
         self.Bind(wx.EVT_MENU, self.__onPrint, self.printMenu)
         self.Bind(wx.EVT_MENU, self.__onPrintPreview, self.printPreviewMenu)
         self.Bind(wx.EVT_MENU, self.__OnExit, self.exitProg)
+        self.Bind(wx.EVT_MENU, self.__onFind, self.findMenu)
+        self.Bind(wx.EVT_MENU, self.__onFindNext, self.findNextMenu)
+        self.Bind(wx.EVT_MENU, self.__onFindAll, self.findAllMenu)
+        self.Bind(wx.EVT_MENU, self.__onReplaceAll, self.replaceAllMenu)
+        self.Bind(wx.EVT_MENU, self.__onFilterColumn, self.filterMenu)
+        self.Bind(wx.EVT_MENU, self.__onClearFilter, self.clearFilterMenu)
+        self.Bind(wx.EVT_MENU, self.__onSortAscending, self.sortAscendingMenu)
+        self.Bind(wx.EVT_MENU, self.__onSortDescending, self.sortDescendingMenu)
+        self.Bind(wx.EVT_MENU, self.__onSortBy, self.sortByMenu)
+        self.Bind(wx.EVT_MENU, self.__onNewScenario, self.newScenarioMenu)
+        self.Bind(wx.EVT_MENU, self.__onSwitchScenario, self.switchScenarioMenu)
+        self.Bind(wx.EVT_MENU, self.__onCompareScenarios, self.compareScenariosMenu)
+        self.Bind(wx.EVT_MENU, self.__onDeleteScenario, self.deleteScenarioMenu)
         self.Bind(wx.EVT_MENU, self.__onHelp, self.helpApp)
         self.Bind(wx.EVT_MENU, self.__onAbout, self.aboutApp)
 
@@ -569,6 +2150,8 @@ class MainFrame(wx.Frame):
         self.saveFile = SpreadsheetDatabase(filePath)
         self.saveFile.createDatabase()
         self.saveFile.saveDatabase(self.__getPopulatedCells())
+        self.saveFile.saveScenarios(self.spreadsheetData.scenarioCells())
+        self.saveFile.saveScenarioBases(self.spreadsheetData.scenarioBaseCells())
     
     def __checkIfFileOverwrite(self, saveFilePath):
         """Check to see if the user is trying to overwrite the file and prompt them if they are"""
@@ -588,12 +2171,11 @@ class MainFrame(wx.Frame):
     
     def __getPopulatedCells(self):
         """Puts all the populated cells into a list of lists [[row, col, type, value], [row, col, type, value], ...]"""
+        # Read from the data model rather than the grid, which may be showing a scenario.
+        # Formulas are saved as entered so that scenarios can recalculate them once the file is reopened.
         populatedCellList = []
-        for col in range(NUMBER_GRID_COLS):
-            for row in range(NUMBER_GRID_ROWS):
-                if (self.mainGrid.GetCellValue(row, col) != ''):
-                    currentCellList = [row, col, 1, self.mainGrid.GetCellValue(row, col)]
-                    populatedCellList.append(currentCellList)
+        for row, col, value, formula in self.spreadsheetData.populatedCells():
+            populatedCellList.append([row, col, 1, formula or value])
         return populatedCellList
 
     def __OnOpen(self, event):
@@ -614,16 +2196,28 @@ class MainFrame(wx.Frame):
         openFile = SpreadsheetDatabase(filePath)
         try:
             openCellList = openFile.loadDatabase()
+            scenarioList = openFile.loadScenarios()
+            baseList = openFile.loadScenarioBases()
         except:
             errorDialog = wx.MessageDialog(None, 'Bad file - loading not completed', 'ERROR', wx.ICON_ERROR | wx.OK)
             errorDialog.ShowModal()
             return
+        self.mainGrid.ClearGrid()
         self.__populateLoadedDataIntoCells(openCellList)
+        try:
+            self.spreadsheetData.loadScenarios(scenarioList, baseList)
+        except Exception, e:
+            # Keep the sheet, which has loaded, without half-loaded scenarios
+            for name in list(self.spreadsheetData.scenarios):
+                self.spreadsheetData.deleteScenario(name)
+            errorDialog = wx.MessageDialog(None, 'Bad scenarios - scenarios not loaded (%s)' % e, 'ERROR', wx.ICON_ERROR | wx.OK)
+            errorDialog.ShowModal()
+        self.__switchScenario(None)
 
     def __populateLoadedDataIntoCells(self, cellList):
-        """Adds all loaded data into the spreadsheet"""
-        for cellData in cellList:
-            self.mainGrid.SetCellValue(cellData[0], cellData[1], cellData[2])
+        """Adds all loaded data into the spreadsheet, calculating formulas once every value is in place"""
+        self.spreadsheetData.setCells([[(row, col, "%s" % value) for (row, col, value) in cellList if value not in (None, "")]])
+        self.mainGrid.ForceRefresh()
 
     def __OnNew(self, event):
         """Clears the spreadsheet"""
@@ -632,6 +2226,8 @@ class MainFrame(wx.Frame):
             self.mainGrid.ClearGrid()
             self.spreadsheetData.reInitialise()
             self.fieldContentText.Clear()
+            self.__onClearFilter()
+            self.__switchScenario(None)
 
     def __promptIsUserSure(self):
         """Sees if the user really wants to start a new spreadsheet"""
@@ -639,6 +2235,32 @@ class MainFrame(wx.Frame):
         newDialogResult = newDialog.ShowModal()
         return newDialogResult
 
+    def __importAny(self, event):
+        """Imports a separated file, detecting the separator"""
+        self.__importFile(None, "All files (*.*)|*.*|csv files (*.csv)|*.csv|txt files (*.txt)|*.txt|Compressed files (*.gz;*.bz2;*.xz)|*.gz;*.bz2;*.xz", "Import separated file")
+
+    def __importUrl(self, event):
+        """Imports a separated file from a URL"""
+        url = self.__promptForText("URL:", "Import from URL", "http://")
+        if url:
+            self.importSource(url)
+
+    def importSource(self, source, separator = None):
+        """Imports a separated file from a path, URL or "-" (stdin)"""
+        if not self.__confirmDiscardScenarios():
+            return
+        self.mainGrid.ClearGrid()
+        self.__switchScenario(None)
+        self.__openSeparatedFile(source, separator)
+
+    def __confirmDiscardScenarios(self):
+        """Asks the user whether to go on with an import that will delete the sheet's scenarios"""
+        if not self.spreadsheetData.scenarios:
+            return True
+        dialogText = "Importing replaces the sheet and deletes its %d scenario(s). Continue?" % len(self.spreadsheetData.scenarios)
+        discardDialog = wx.MessageDialog(None, dialogText, 'Delete scenarios?', wx.YES_NO | wx.NO_DEFAULT | wx.ICON_QUESTION)
+        return discardDialog.ShowModal() == wx.ID_YES
+
     def __importCsv(self, event):
         """Imports a CSV file"""
         self.__importFile(",", "csv files (*.csv)|*.csv", "Import CSV file")
@@ -659,24 +2281,80 @@ class MainFrame(wx.Frame):
         """Imports a file"""
         openDialogResult = self.__promptForImportFile(openFilters, dialogMessage)
         if (openDialogResult.ShowModal() == wx.ID_OK):
-            self.mainGrid.ClearGrid()
-            self.__openSeparatedFile(openDialogResult.GetPath(), separator)
+            self.importSource(openDialogResult.GetPath(), separator)
     
     def __promptForImportFile(self, openFilters, dialogMessage):
         """Prompts the user for a Csv file to load"""
         openDialog = wx.FileDialog(None, message = dialogMessage, wildcard = openFilters, style = wx.OPEN)
         return openDialog
 
-    def __openSeparatedFile(self, filePath, separator):
-        """Loads a separated file"""
-        csvFile = csv.reader(open(filePath), delimiter=separator)
-        rowNum = 0
-        for line in csvFile:
-            colNum = 0
-            for value in line:
-                self.mainGrid.SetCellValue(rowNum, colNum, value.strip(" "))
-                colNum += 1         
-            rowNum += 1
+    def __openSeparatedFile(self, filePath, separator = None):
+        """Loads a separated file (the separator is detected if not given)"""
+        # The progress dialog keeps the window responsive while rows arrive and lets the user cancel
+        progressDialog = wx.ProgressDialog("Import", "Importing %s..." % filePath, parent = self, style = wx.PD_CAN_ABORT | wx.PD_APP_MODAL)
+        fileReader = SeparatedFileReader(filePath, separator, lambda: progressDialog.Pulse()[0])
+        try:
+            importedRows = self.spreadsheetData.setRows(fileReader.rowBatches())
+        except Exception, e:
+            progressDialog.Destroy()
+            errorDialog = wx.MessageDialog(None, 'Bad file - import not completed (%s)' % e, 'ERROR', wx.ICON_ERROR | wx.OK)
+            errorDialog.ShowModal()
+            self.mainGrid.ForceRefresh()
+            return
+        progressDialog.Destroy()
+        self.mainGrid.ForceRefresh()
+        if fileReader.cancelled:
+            self.mainStatusBar.SetStatusText("Import cancelled - %d rows imported" % importedRows)
+        else:
+            self.mainStatusBar.SetStatusText("%d rows imported" % importedRows)
+
+    def __importXlsx(self, event):
+        """Imports an Excel workbook"""
+        openDialogResult = self.__promptForImportFile("Excel workbooks (*.xlsx)|*.xlsx", "Import Excel workbook")
+        if (openDialogResult.ShowModal() == wx.ID_OK):
+            self.__openSpreadsheetFile(XlsxFile(openDialogResult.GetPath()))
+
+    def __importOds(self, event):
+        """Imports an OpenDocument spreadsheet"""
+        openDialogResult = self.__promptForImportFile("OpenDocument spreadsheets (*.ods)|*.ods", "Import OpenDocument spreadsheet")
+        if (openDialogResult.ShowModal() == wx.ID_OK):
+            self.__openSpreadsheetFile(OdsFile(openDialogResult.GetPath()))
+
+    def __openSpreadsheetFile(self, spreadsheetFile):
+        """Loads the first sheet of an xlsx or ods file"""
+        if not self.__confirmDiscardScenarios():
+            return
+        self.mainGrid.ClearGrid()
+        self.__switchScenario(None)
+        wx.BeginBusyCursor()
+        try:
+            importedCells = self.spreadsheetData.setCells(spreadsheetFile.loadCells())
+        except Exception, e:
+            wx.EndBusyCursor()
+            errorDialog = wx.MessageDialog(None, 'Bad file - import not completed (%s)' % e, 'ERROR', wx.ICON_ERROR | wx.OK)
+            errorDialog.ShowModal()
+            self.mainGrid.ForceRefresh()
+            return
+        wx.EndBusyCursor()
+        self.mainGrid.ForceRefresh()
+        self.mainStatusBar.SetStatusText("%d cells imported" % importedCells)
+
+    def __exportXlsx(self, event):
+        """Exports an Excel workbook"""
+        exportDialogResult = self.__promptForExportFile("Excel workbooks (*.xlsx)|*.xlsx", "Export Excel workbook")
+        if (exportDialogResult.ShowModal() == wx.ID_OK):
+            XlsxFile(exportDialogResult.GetPath()).saveCells(self.spreadsheetData.populatedCells())
+
+    def __exportOds(self, event):
+        """Exports an OpenDocument spreadsheet"""
+        exportDialogResult = self.__promptForExportFile("OpenDocument spreadsheets (*.ods)|*.ods", "Export OpenDocument spreadsheet")
+        if (exportDialogResult.ShowModal() == wx.ID_OK):
+            OdsFile(exportDialogResult.GetPath()).saveCells(self.spreadsheetData.populatedCells())
+
+    def __promptForExportFile(self, exportFilters, dialogMessage):
+        """Prompts the user for a file to export to"""
+        exportDialog = wx.FileDialog(None, message = dialogMessage, wildcard = exportFilters, style = wx.SAVE)
+        return exportDialog
 
     def __exportCsv(self, event):
         """Exports a CSV file"""
@@ -699,9 +2377,9 @@ class MainFrame(wx.Frame):
             outString = ''
             for col in range(finalPopulatedColumn + 1):
                 if col == 0:
-                    outString += "%s" % self.mainGrid.GetCellValue(row, col)   
+                    outString += "%s" % self.spreadsheetData.getBaseValue(row, col)   
                 else:
-                    outString += ", %s" % self.mainGrid.GetCellValue(row, col)     
+                    outString += ", %s" % self.spreadsheetData.getBaseValue(row, col)     
             outString += "\n"
             csvWriter.write(outString)
         csvWriter.close()
@@ -711,7 +2389,7 @@ class MainFrame(wx.Frame):
         finalRowNum = 0
         for row in range(NUMBER_GRID_ROWS):
             for col in range(NUMBER_GRID_ROWS):
-                if (self.mainGrid.GetCellValue(row, col) != ''):
+                if (self.spreadsheetData.getBaseValue(row, col) != ''):
                     finalRowNum = row
                     break
         return finalRowNum
@@ -720,10 +2398,197 @@ class MainFrame(wx.Frame):
         """Finds the final populated column in a given row"""
         finalColNum = 0
         for col in range(NUMBER_GRID_COLS):
-            if (self.mainGrid.GetCellValue(row, col) != ''):
+            if (self.spreadsheetData.getBaseValue(row, col) != ''):
                 finalColNum = col
         return finalColNum
     
+    def __promptForText(self, message, caption, defaultValue=''):
+        """Prompts the user for a line of text, returning None if they cancel"""
+        textDialog = wx.TextEntryDialog(None, message, caption, defaultValue)
+        if (textDialog.ShowModal() == wx.ID_OK):
+            return textDialog.GetValue()
+        return None
+
+    def __cellLabel(self, row, col):
+        """Returns the label of a cell e.g. A1"""
+        return self.spreadsheetData.references.encode(row, col)
+
+    def __onFind(self, event=''):
+        """Prompts the user for a value and moves to the next cell containing it"""
+        findText = self.__promptForText("Find what:", "Find", self.lastFindText)
+        if findText:
+            self.lastFindText = findText
+            self.__onFindNext()
+
+    def __onFindNext(self, event=''):
+        """Moves to the next cell containing the last value searched for"""
+        if not self.lastFindText:
+            self.__onFind()
+            return
+        foundCell = self.spreadsheetData.findNextCell(self.lastFindText, self.mainGrid.GetGridCursorRow(), self.mainGrid.GetGridCursorCol())
+        if foundCell is None:
+            self.mainStatusBar.SetStatusText("'%s' not found" % self.lastFindText)
+            return
+        self.mainGrid.SetGridCursor(foundCell[0], foundCell[1])
+        self.mainGrid.MakeCellVisible(foundCell[0], foundCell[1])
+        self.mainStatusBar.SetStatusText("'%s' found in %s" % (self.lastFindText, self.__cellLabel(foundCell[0], foundCell[1])))
+
+    def __onFindAll(self, event):
+        """Selects every cell containing a value"""
+        findText = self.__promptForText("Find what:", "Find all", self.lastFindText)
+        if not findText:
+            return
+        self.lastFindText = findText
+        foundCells = self.spreadsheetData.findCells(findText)
+        self.mainGrid.ClearSelection()
+        for row, col in foundCells:
+            self.mainGrid.SelectBlock(row, col, row, col, True)
+        if foundCells:
+            self.mainGrid.MakeCellVisible(foundCells[0][0], foundCells[0][1])
+        self.mainStatusBar.SetStatusText("%d cells found" % len(foundCells))
+
+    def __onReplaceAll(self, event):
+        """Replaces a value throughout the sheet"""
+        findText = self.__promptForText("Find what:", "Replace all", self.lastFindText)
+        if not findText:
+            return
+        replaceText = self.__promptForText("Replace with:", "Replace all")
+        if replaceText is None:
+            return
+        self.lastFindText = findText
+        replacedCount = self.spreadsheetData.replaceAll(findText, replaceText)
+        self.mainGrid.ForceRefresh()
+        self.mainStatusBar.SetStatusText("%d cells replaced" % replacedCount)
+
+    def __onFilterColumn(self, event):
+        """Hides the rows that don't match a filter on the current column"""
+        col = self.mainGrid.GetGridCursorCol()
+        message = "Show rows where column %s is (e.g. 'abc', '> 100', '<> 0'):" % self.spreadsheetData.references.columnLabel(col)
+        predicate = self.__promptForText(message, "Filter column")
+        if not predicate:
+            return
+        try:
+            matchingRows = set(self.spreadsheetData.filterColumn(col, predicate))
+        except ValueError, e:
+            errorDialog = wx.MessageDialog(None, str(e), 'ERROR', wx.ICON_ERROR | wx.OK)
+            errorDialog.ShowModal()
+            return
+        defaultRowSize = self.mainGrid.GetDefaultRowSize()
+        for row in range(NUMBER_GRID_ROWS):
+            if row in matchingRows:
+                self.mainGrid.SetRowSize(row, defaultRowSize)
+            else:
+                self.mainGrid.SetRowSize(row, 0)
+        self.mainGrid.ForceRefresh()
+        self.mainStatusBar.SetStatusText("%d rows match filter" % len(matchingRows))
+
+    def __onClearFilter(self, event=''):
+        """Shows all rows again"""
+        defaultRowSize = self.mainGrid.GetDefaultRowSize()
+        for row in range(NUMBER_GRID_ROWS):
+            self.mainGrid.SetRowSize(row, defaultRowSize)
+        self.mainGrid.ForceRefresh()
+
+    def __onSortAscending(self, event):
+        """Sorts rows by the current column, smallest first"""
+        self.__sortSelection([(self.mainGrid.GetGridCursorCol(), True)])
+
+    def __onSortDescending(self, event):
+        """Sorts rows by the current column, largest first"""
+        self.__sortSelection([(self.mainGrid.GetGridCursorCol(), False)])
+
+    def __onSortBy(self, event):
+        """Prompts the user for the columns to sort rows by"""
+        sortText = self.__promptForText("Sort by columns (e.g. 'B, A desc'):", "Sort by")
+        if not sortText:
+            return
+        try:
+            sortKeys = self.spreadsheetData.parseSortKeys(sortText)
+        except ValueError, e:
+            errorDialog = wx.MessageDialog(None, str(e), 'ERROR', wx.ICON_ERROR | wx.OK)
+            errorDialog.ShowModal()
+            return
+        self.__sortSelection(sortKeys)
+
+    def __sortSelection(self, sortKeys):
+        """Sorts the selected block (or the whole populated area if nothing is selected) and refreshes the grid once"""
+        topLeft = self.mainGrid.GetSelectionBlockTopLeft()
+        bottomRight = self.mainGrid.GetSelectionBlockBottomRight()
+        if topLeft and bottomRight:
+            firstRow, firstCol = topLeft[0]
+            lastRow, lastCol = bottomRight[0]
+        else:
+            lastCell = self.spreadsheetData.getLastPopulatedCell()
+            if lastCell is None:
+                return
+            firstRow, firstCol = 0, 0
+            lastRow, lastCol = lastCell
+        if self.spreadsheetData.sortRows(firstRow, lastRow, firstCol, lastCol, sortKeys):
+            self.mainGrid.ForceRefresh()
+
+    def __onNewScenario(self, event):
+        """Creates a scenario from the current sheet and switches to it"""
+        name = self.__promptForText("Scenario name:", "New scenario")
+        if not name:
+            return
+        if name in self.spreadsheetData.scenarios:
+            errorDialog = wx.MessageDialog(None, "There is already a scenario called %s" % name, 'ERROR', wx.ICON_ERROR | wx.OK)
+            errorDialog.ShowModal()
+            return
+        self.spreadsheetData.setActiveScenario(None)
+        self.spreadsheetData.createScenario(name)
+        self.__switchScenario(name)
+
+    def __onSwitchScenario(self, event):
+        """Prompts the user for the scenario (or the sheet itself) to show in the grid"""
+        names = sorted(self.spreadsheetData.scenarios)
+        choiceDialog = wx.SingleChoiceDialog(None, "Show:", "Switch scenario", ["(sheet)"] + names)
+        if (choiceDialog.ShowModal() == wx.ID_OK):
+            if choiceDialog.GetSelection() == 0:
+                self.__switchScenario(None)
+            else:
+                self.__switchScenario(names[choiceDialog.GetSelection() - 1])
+
+    def __switchScenario(self, name):
+        """Shows a scenario (or with None, the sheet itself) in the grid"""
+        self.spreadsheetData.setActiveScenario(name)
+        self.__updateSheetOnlyMenus()
+        self.mainGrid.ForceRefresh()
+        if name is None:
+            self.mainStatusBar.SetStatusText("")
+        else:
+            self.mainStatusBar.SetStatusText("Scenario: %s" % name)
+
+    def __updateSheetOnlyMenus(self):
+        """Enables find, replace, filter and sort only while the sheet itself is shown, as they work on the sheet"""
+        sheetShown = self.spreadsheetData.activeScenario is None
+        for menuItem in (self.findMenu, self.findNextMenu, self.findAllMenu, self.replaceAllMenu, self.filterMenu,
+                         self.sortAscendingMenu, self.sortDescendingMenu, self.sortByMenu):
+            menuItem.Enable(sheetShown)
+
+    def __onCompareScenarios(self, event):
+        """Shows the cells changed by each scenario side by side"""
+        names = sorted(self.spreadsheetData.scenarios)
+        if not names:
+            wx.MessageBox("There are no scenarios to compare", "Compare scenarios")
+            return
+        compareText = "Cell\tSheet\t%s\n" % "\t".join(names)
+        for row, col, baseValue, scenarioValues in self.spreadsheetData.compareScenarios(names):
+            compareText += "%s\t%s\t%s\n" % (self.__cellLabel(row, col), baseValue, "\t".join("%s" % value for value in scenarioValues))
+        compareDialog = wx.lib.dialogs.ScrolledMessageDialog(self, compareText, "Compare scenarios")
+        compareDialog.ShowModal()
+
+    def __onDeleteScenario(self, event):
+        """Prompts the user for a scenario to delete"""
+        names = sorted(self.spreadsheetData.scenarios)
+        if not names:
+            return
+        choiceDialog = wx.SingleChoiceDialog(None, "Delete:", "Delete scenario", names)
+        if (choiceDialog.ShowModal() == wx.ID_OK):
+            self.spreadsheetData.deleteScenario(names[choiceDialog.GetSelection()])
+            if self.spreadsheetData.activeScenario is None:
+                self.__switchScenario(None)
+
     def __onHelp(self, event):
         """Launch help text"""
         os.startfile("pyXL_help.txt")
@@ -752,7 +2617,7 @@ class MainFrame(wx.Frame):
         for rowNum in range(finalPopulatedRow+1):
             printText += "<tr>"
             for colNum in range(finalPopulatedCol+1):
-                printText += "<td>%s</td>" % self.spreadsheetData.GetValue(rowNum, colNum)
+                printText += "<td>%s</td>" % self.spreadsheetData.getBaseValue(rowNum, colNum)
             printText += "</tr>"
         printText += "</table>"
         return printText
@@ -762,7 +2627,7 @@ class MainFrame(wx.Frame):
         finalColNum = 0
         for col in range(NUMBER_GRID_COLS):
             for row in range(NUMBER_GRID_ROWS):
-                if (self.mainGrid.GetCellValue(row, col) != ''):
+                if (self.spreadsheetData.getBaseValue(row, col) != ''):
                     finalColNum = col
         return finalColNum
     
@@ -773,8 +2638,7 @@ class MainFrame(wx.Frame):
     
     def __updateContentBarWithCellValue(self, event):
         """Updates the main page content bar when user clicks on a cell"""
-        self.mainGrid.GetColLabelValue(event.GetCol()) + self.mainGrid.GetRowLabelValue(event.GetRow())
-        self.currentFieldText.SetValue(self.mainGrid.GetColLabelValue(event.GetCol()) + self.mainGrid.GetRowLabelValue(event.GetRow()))
+        self.currentFieldText.SetValue(self.__cellLabel(event.GetRow(), event.GetCol()))
         displayString = self.spreadsheetData.getFormula(event.GetRow(), event.GetCol())
         if (displayString):
             self.fieldContentText.SetValue(displayString)
@@ -797,13 +2661,243 @@ class MainFrame(wx.Frame):
         """Deals with the user exiting the app"""
         self.Destroy()
 
+#---Server objects (headless mode)
+
+class SpreadsheetServer(asyncore.dispatcher):
+    """Shares one sheet between several clients over a local socket.
+
+    Each request and response is one line of JSON, e.g.
+        {"op": "get", "range": "A1:B2"}                          -> {"ok": true, "values": [["1", "2"], ["3", 4]]}
+        {"op": "set", "cells": {"A1": "5", "B1": "=A1+A1"}}      -> {"ok": true, "queued": 2}
+        {"op": "set", "range": "A1", "values": [["1", "2"]]}     -> {"ok": true, "queued": 2}
+        {"op": "recalc"}, {"op": "save"}, {"op": "unsubscribe"}  -> {"ok": true}
+        {"op": "subscribe", "range": "A1:Z100"}                  -> {"ok": true}
+    Subscribers are sent {"event": "changed", "cells": {"A1": "5", ...}} after each batch of writes.
+    An "id" in a request is copied into its response.
+
+    Writes are queued and applied together (with one recalculation) once the
+    waiting requests have been read; a get applies queued writes first."""
+    def __init__(self, databaseName, port = SERVER_PORT):
+        self.socketMap = {}
+        asyncore.dispatcher.__init__(self, map = self.socketMap)
+        self.databaseName = databaseName
+        self.spreadsheetData = DataTable()
+        self.pendingWrites = {}
+        self.clients = []
+        self.__loadDatabase()
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((SERVER_HOST, port))
+        self.listen(5)
+
+    def __loadDatabase(self):
+        """Loads the sheet from the pyXL file, if it exists"""
+        if not os.path.exists(self.databaseName):
+            return
+        cellList = SpreadsheetDatabase(self.databaseName).loadDatabase()
+        self.spreadsheetData.setCells([[(row, col, "%s" % value) for (row, col, value) in cellList if value not in (None, "")]])
+
+    def __saveDatabase(self):
+        """Saves the sheet to the pyXL file"""
+        if os.path.exists(self.databaseName):
+            os.remove(self.databaseName)
+        saveFile = SpreadsheetDatabase(self.databaseName)
+        saveFile.createDatabase()
+        # Formulas are saved as entered; loading recalculates them once every value is in place
+        saveFile.saveDatabase([[row, col, 1, formula or value] for (row, col, value, formula) in self.spreadsheetData.populatedCells()])
+
+    def serveForever(self):
+        """Handles requests until the process is stopped"""
+        while True:
+            asyncore.loop(SERVER_POLL_TIMEOUT, False, self.socketMap, 1)
+            try:
+                self.flushWrites()
+            except Exception, e:
+                # One bad batch of writes mustn't stop the server for every client
+                print "Error applying writes: %s" % e
+
+    def handle_accept(self):
+        """Accepts a new client"""
+        connection = self.accept()
+        if connection is not None:
+            self.clients.append(SpreadsheetClientHandler(connection[0], self))
+
+    def removeClient(self, client):
+        """Forgets a client that has disconnected"""
+        if client in self.clients:
+            self.clients.remove(client)
+
+    def handleRequest(self, client, request):
+        """Carries out a request and returns the response"""
+        operation = request.get("op")
+        if operation == "get":
+            self.flushWrites()
+            firstRow, firstCol, lastRow, lastCol = self.spreadsheetData.references.decodeRange(request["range"])
+            getValue = self.spreadsheetData.GetValue
+            values = [[getValue(row, col) for col in range(firstCol, lastCol + 1)] for row in range(firstRow, lastRow + 1)]
+            return {"ok": True, "values": values}
+        if operation == "set":
+            return {"ok": True, "queued": self.__queueWrites(request)}
+        if operation == "recalc":
+            self.flushWrites()
+            self.__recalculate(set())
+            return {"ok": True}
+        if operation == "subscribe":
+            if "range" in request:
+                client.subscribedRange = self.spreadsheetData.references.decodeRange(request["range"])
+            else:
+                client.subscribedRange = (0, 0, sys.maxint, sys.maxint)
+            return {"ok": True}
+        if operation == "unsubscribe":
+            client.subscribedRange = None
+            return {"ok": True}
+        if operation == "save":
+            self.flushWrites()
+            self.__saveDatabase()
+            return {"ok": True}
+        raise ValueError("Unknown op '%s'" % operation)
+
+    def __queueWrites(self, request):
+        """Queues the cell values in a set request and returns how many there were.
+        Nothing is queued unless the whole request is valid."""
+        references = self.spreadsheetData.references
+        requestWrites = []
+        if "cells" in request:
+            for reference, value in request["cells"].iteritems():
+                requestWrites.append((references.decode(reference), self.__cellText(value)))
+        if "values" in request:
+            firstRow, firstCol = references.decode(request["range"].split(":")[0])
+            for rowOffset, rowValues in enumerate(request["values"]):
+                for colOffset, value in enumerate(rowValues):
+                    requestWrites.append(((firstRow + rowOffset, firstCol + colOffset), self.__cellText(value)))
+        self.pendingWrites.update(requestWrites)
+        return len(requestWrites)
+
+    def __cellText(self, value):
+        """Converts a JSON value into the text stored in a cell (None clears the cell)"""
+        if value is None:
+            return ""
+        if isinstance(value, basestring):
+            return value
+        return json.dumps(value)
+
+    def flushWrites(self):
+        """Applies the queued writes, recalculating formulas once"""
+        if not self.pendingWrites:
+            return
+        pendingWrites = self.pendingWrites
+        self.pendingWrites = {}
+        formulaValues = self.__formulaValues()
+        # Plain values first so that new formulas can see them, then formulas after the ones they refer to
+        formulaWrites = {}
+        for (row, col), value in pendingWrites.iteritems():
+            if value[:1] == "=":
+                formulaWrites[(row, col)] = value
+            else:
+                self.__applyWrite(row, col, value)
+        for row, col in self.spreadsheetData.dependencyOrder(formulaWrites):
+            self.__applyWrite(row, col, formulaWrites[(row, col)])
+        self.__recalculate(set(pendingWrites), formulaValues)
+
+    def __applyWrite(self, row, col, value):
+        """Sets one cell, storing !ERR for it if the write fails"""
+        try:
+            self.spreadsheetData.SetValue(row, col, value)
+        except Exception, e:
+            self.spreadsheetData.SetValue(row, col, "!ERR %s" % value)
+
+    def __formulaValues(self):
+        """Returns the current value of every formula cell"""
+        data = self.spreadsheetData.data
+        return dict((cell, data.get(cell)) for cell in self.spreadsheetData.formulas)
+
+    def __recalculate(self, changedCells, formulaValues = None):
+        """Recalculates formulas and notifies subscribers of changedCells plus any formula whose value changed"""
+        if formulaValues is None:
+            formulaValues = self.__formulaValues()
+        self.spreadsheetData.refreshFormulas()
+        data = self.spreadsheetData.data
+        for cell, oldValue in formulaValues.iteritems():
+            if data.get(cell) != oldValue:
+                changedCells.add(cell)
+        if changedCells:
+            self.__notifySubscribers(changedCells)
+
+    def __notifySubscribers(self, changedCells):
+        """Sends the changed cells in each subscriber's range to it"""
+        encode = self.spreadsheetData.references.encode
+        getValue = self.spreadsheetData.GetValue
+        for client in self.clients:
+            if client.subscribedRange is None:
+                continue
+            firstRow, firstCol, lastRow, lastCol = client.subscribedRange
+            cells = {}
+            for row, col in changedCells:
+                if firstRow <= row <= lastRow and firstCol <= col <= lastCol:
+                    cells[encode(row, col)] = getValue(row, col)
+            if cells:
+                client.sendMessage({"event": "changed", "cells": cells})
+
+class SpreadsheetClientHandler(asynchat.async_chat):
+    """One client connection to a SpreadsheetServer"""
+    def __init__(self, connection, server):
+        asynchat.async_chat.__init__(self, connection, server.socketMap)
+        self.server = server
+        self.incomingData = []
+        self.subscribedRange = None
+        self.set_terminator("\n")
+
+    def collect_incoming_data(self, data):
+        """Buffers part of a request"""
+        self.incomingData.append(data)
+
+    def found_terminator(self):
+        """Handles a complete request line"""
+        line = "".join(self.incomingData)
+        self.incomingData = []
+        if not line.strip():
+            return
+        requestId = None
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("Request must be a JSON object")
+            requestId = request.get("id")
+            response = self.server.handleRequest(self, request)
+        except (ValueError, KeyError, TypeError, AttributeError), e:
+            response = {"ok": False, "error": "%s" % e}
+        if requestId is not None:
+            response["id"] = requestId
+        self.sendMessage(response)
+
+    def sendMessage(self, message):
+        """Sends one JSON line to the client"""
+        self.push(json.dumps(message, separators = (",", ":")) + "\n")
+
+    def handle_close(self):
+        """Cleans up when the client disconnects"""
+        self.server.removeClient(self)
+        self.close()
+
 #---Main section
 
 def main():
+    if len(sys.argv) > 2 and sys.argv[1] == "--serve":
+        # Headless server e.g. pyXL.py --serve sheet.pyx [port]
+        port = SERVER_PORT
+        if len(sys.argv) > 3:
+            port = int(sys.argv[3])
+        server = SpreadsheetServer(sys.argv[2], port)
+        print "pyXL serving %s on %s:%d" % (sys.argv[2], SERVER_HOST, port)
+        server.serveForever()
+        return 0
      # Start GUI
     app = wx.App(redirect=False)
     frame = MainFrame(None, -1, "pyXL")
     frame.Show(True)
+    if len(sys.argv) > 1:
+        # e.g. pyXL.py data.csv.gz, or pyXL.py - < data.csv
+        frame.importSource(sys.argv[1])
     app.MainLoop()
     return 0
 